@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+#
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Toolchain artifact cache shared by every workspace on a machine.
+
+Each entry is the unpacked contents of one release artifact, keyed by its
+release name or commit, under $SPARROW_ARTIFACT_CACHE (default
+~/.cache/sparrow-artifacts). Workspaces install from an entry by reflinking
+or hardlinking its files, so an artifact is downloaded and stored once no
+matter how many checkouts use it.
+
+Entries are filled and read under fcntl locks, so concurrent fetchers of the
+same artifact wait for a single download, and entries in use are never
+evicted. When the cache grows past its budget
+($SPARROW_ARTIFACT_CACHE_GB, default 20) the least recently used entries are
+removed.
+"""
+
+import contextlib
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import stat
+import tempfile
+import time
+
+import download_util
+
+DEFAULT_DIR = os.path.join(os.path.expanduser("~"), ".cache",
+                           "sparrow-artifacts")
+DEFAULT_BUDGET_GB = 20
+
+# ioctl to share the blocks of one file with another on btrfs/xfs
+FICLONE = 0x40049409
+
+
+def tree_size(path):
+    """Bytes used by the files under {path}, counting hard links once."""
+    seen = set()
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            st = os.lstat(os.path.join(root, name))
+            if (st.st_dev, st.st_ino) not in seen:
+                seen.add((st.st_dev, st.st_ino))
+                total += st.st_size
+    return total
+
+
+def clone_file(src, dst):
+    """Makes {dst} a copy of {src} sharing its storage: a reflink where the
+    filesystem supports it, else a hard link, else a plain copy."""
+    try:
+        with open(src, "rb") as s, open(dst, "wb") as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        shutil.copystat(src, dst)
+        return
+    except OSError:
+        if os.path.lexists(dst):
+            os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        shutil.copy2(src, dst)
+
+
+def link_tree(src, dst):
+    """Recreates the tree at {src} in the new directory {dst} with
+    clone_file."""
+    for root, dirs, files in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(target, exist_ok=True)
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), os.path.join(target, name))
+                if name in dirs:
+                    dirs.remove(name)
+            elif name in files:
+                clone_file(path, os.path.join(target, name))
+
+
+class ArtifactCache:
+    """See the module docstring. Each entry is a directory holding the
+    unpacked `tree`, a `meta.json` and a `last_used` stamp; locks live
+    next to the entries."""
+
+    def __init__(self, root=None, budget_bytes=None):
+        self.root = root or os.getenv("SPARROW_ARTIFACT_CACHE") or DEFAULT_DIR
+        if budget_bytes is None:
+            budget_gb = os.getenv("SPARROW_ARTIFACT_CACHE_GB",
+                                  str(DEFAULT_BUDGET_GB))
+            budget_bytes = int(float(budget_gb) * (1 << 30))
+        self.budget_bytes = budget_bytes
+        self.entries = os.path.join(self.root, "entries")
+        self.locks = os.path.join(self.root, "locks")
+        os.makedirs(self.entries, exist_ok=True)
+        os.makedirs(self.locks, exist_ok=True)
+
+    @staticmethod
+    def entry_name(key):
+        """A directory name for {key}: readable, with a hash of the key so
+        that keys differing only in replaced characters stay apart."""
+        digest = hashlib.sha256(key.encode()).hexdigest()[:12]
+        return "%s-%s" % (re.sub(r"[^\w.\-]", "_", key), digest)
+
+    def lock_file(self, name):
+        return open(os.path.join(self.locks, name + ".lock"), "a+b")
+
+    @contextlib.contextmanager
+    def entry(self, key, fill):
+        """Yields the path of the unpacked tree for {key}, calling
+        {fill}(directory) to populate it first if it is not cached. The
+        entry cannot be evicted until the context exits."""
+        name = self.entry_name(key)
+        entry_dir = os.path.join(self.entries, name)
+        tree = os.path.join(entry_dir, "tree")
+        with self.lock_file(name) as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not os.path.exists(os.path.join(entry_dir, "meta.json")):
+                self.fill(key, entry_dir, fill)
+            else:
+                print(f"Using cached {key}")
+            with open(os.path.join(entry_dir, "last_used"), "w",
+                      encoding="utf-8") as f:
+                f.write(f"{time.time()}\n")
+            # Let other readers in while this one uses the entry
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            yield tree
+        self.evict()
+
+    def fill(self, key, entry_dir, fill):
+        print(f"Caching {key} in {self.root}")
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        staging_dir = tempfile.mkdtemp(prefix=".fill-", dir=self.entries)
+        try:
+            tree = os.path.join(staging_dir, "tree")
+            os.makedirs(tree)
+            fill(tree)
+            # Installs share these files, so keep them from being changed
+            # through an install.
+            for root, _, files in os.walk(tree):
+                for name in files:
+                    path = os.path.join(root, name)
+                    if not os.path.islink(path):
+                        mode = os.lstat(path).st_mode
+                        os.chmod(path, mode & ~(stat.S_IWUSR | stat.S_IWGRP |
+                                                stat.S_IWOTH))
+            with open(os.path.join(staging_dir, "meta.json"), "w",
+                      encoding="utf-8") as f:
+                json.dump({"key": key, "size": tree_size(tree),
+                           "created": time.time()}, f)
+            os.replace(staging_dir, entry_dir)
+        except BaseException:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
+
+    def install(self, key, out_dir, fill):
+        """Installs the tree cached for {key} into {out_dir}, replacing its
+        entries with the same names. See entry() for {fill}."""
+        with self.entry(key, fill) as tree:
+            parent = os.path.dirname(os.path.abspath(out_dir))
+            os.makedirs(parent, exist_ok=True)
+            staging_dir = tempfile.mkdtemp(prefix=".install-", dir=parent)
+            try:
+                link_tree(tree, staging_dir)
+                download_util.install_tree(staging_dir, out_dir)
+            finally:
+                shutil.rmtree(staging_dir, ignore_errors=True)
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits its
+        budget. Entries in use are skipped, and only one process evicts at
+        a time."""
+        with open(os.path.join(self.root, "evict.lock"), "a+b") as evict_lock:
+            try:
+                fcntl.flock(evict_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            entries = []
+            for name in os.listdir(self.entries):
+                # Skip entries still being filled
+                if name.startswith("."):
+                    continue
+                entry_dir = os.path.join(self.entries, name)
+                try:
+                    with open(os.path.join(entry_dir, "meta.json"), "r",
+                              encoding="utf-8") as f:
+                        size = json.load(f)["size"]
+                    used = os.path.getmtime(os.path.join(entry_dir,
+                                                         "last_used"))
+                except (OSError, ValueError, KeyError):
+                    continue
+                entries.append((used, name, size))
+            total = sum(size for _, _, size in entries)
+            for _, name, size in sorted(entries):
+                if total <= self.budget_bytes:
+                    break
+                with self.lock_file(name) as lock:
+                    try:
+                        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue
+                    print(f"Evicting {name} from the artifact cache")
+                    shutil.rmtree(os.path.join(self.entries, name),
+                                  ignore_errors=True)
+                    total -= size
@@ -1,15 +1,274 @@
 #!/usr/bin/env python3
 
-import base64
+import argparse
+import asyncio
+import binascii
 import cmd
+import collections
+import concurrent.futures
+import contextlib
 import curses.ascii
+import errno
+import glob
+import hashlib
+import itertools
+import json
+import mmap
+import os
 import select
+import shlex
 import socket
 import sys
+import termios
 import time
+import tty
+import zlib
 
+from elftools.common.exceptions import ELFError
 from elftools.elf.elffile import ELFFile
 
+from uart_expect import Expect, UartExpect
+
+
+# Maps {file} read-only and returns a memoryview of it, so slices of it can be
+# uploaded without copying the file into memory.
+def map_file(file):
+    if os.fstat(file.fileno()).st_size == 0:
+        return memoryview(b"")
+    return memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+# Returns a view of the bytes a PT_LOAD segment loads from the mapped ELF
+def segment_view(mapping, offset, size):
+    return mapping[offset:offset + size]
+
+
+def page_hashes(data, page_size):
+    return [
+        hashlib.blake2b(data[i:i + page_size], digest_size=16).hexdigest()
+        for i in range(0, len(data), page_size)
+    ]
+
+
+# Parses {filename} and returns its upload plan: the entry point and, for each
+# PT_LOAD segment, its load address, file range and page hashes.
+def build_upload_plan(filename, page_size):
+    with open(filename, "rb") as file:
+        stat = os.fstat(file.fileno())
+        elf_file = ELFFile(file)
+        segments = []
+        for segment in elf_file.iter_segments():
+            header = segment.header
+            if header.p_type == "PT_LOAD":
+                segments.append({
+                    "paddr": header.p_paddr,
+                    "offset": header.p_offset,
+                    "filesz": header.p_filesz,
+                })
+        entry = elf_file.header.e_entry
+        mapping = map_file(file)
+
+    # Hashing releases the GIL, so large segments hash in parallel.
+    with concurrent.futures.ThreadPoolExecutor() as pool:
+        hashes = pool.map(
+            lambda seg: page_hashes(
+                segment_view(mapping, seg["offset"], seg["filesz"]), page_size
+            ), segments)
+        for segment, pages in zip(segments, hashes):
+            segment["pages"] = pages
+
+    return {
+        "path": os.path.realpath(filename),
+        "mtime_ns": stat.st_mtime_ns,
+        "size": stat.st_size,
+        "page_size": page_size,
+        "entry": entry,
+        "segments": segments,
+    }
+
+
+# Returns the upload plan for {filename}, from {cache_dir} if the file's path,
+# mtime and size match a cached plan, so unchanged binaries skip ELF parsing.
+def load_upload_plan(filename, cache_dir, page_size):
+    path = os.path.realpath(filename)
+    stat = os.stat(path)
+    key = hashlib.blake2b(path.encode(), digest_size=16).hexdigest()
+    plan_path = os.path.join(cache_dir, f"{key}.json")
+    try:
+        with open(plan_path, "r", encoding="utf-8") as f:
+            plan = json.load(f)
+        if (plan["path"] == path and plan["mtime_ns"] == stat.st_mtime_ns
+                and plan["size"] == stat.st_size
+                and plan["page_size"] == page_size):
+            return plan
+    except (OSError, ValueError, KeyError):
+        pass
+
+    plan = build_upload_plan(path, page_size)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{plan_path}.{os.getpid()}"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(plan, f, separators=(",", ":"))
+        os.replace(tmp_path, plan_path)
+    except OSError as e:
+        print(f"Could not save upload plan: {e}")
+    return plan
+
+
+# Yields exponentially growing delays, starting at {start} seconds and capped
+# at {limit}, until {deadline} has passed.
+def backoff(deadline, start=0.005, limit=1.0):
+    delay = start
+    while time.monotonic() < deadline:
+        yield min(delay, max(deadline - time.monotonic(), 0))
+        delay = min(2 * delay, limit)
+
+
+def split_chunks(blob, address, chunk_size):
+    return [(address + i, blob[i:i + chunk_size])
+            for i in range(0, len(blob), chunk_size)]
+
+
+# Splits {data} into (offset, size, is_zero) runs of whole pages
+def zero_runs(data, page_size):
+    zero_page = bytes(page_size)
+    runs = []
+    for offset in range(0, len(data), page_size):
+        page = data[offset:offset + page_size]
+        is_zero = len(page) == page_size and page == zero_page
+        if runs and runs[-1][2] == is_zero:
+            runs[-1][1] += len(page)
+        else:
+            runs.append([offset, len(page), is_zero])
+    return runs
+
+
+# Turns (address, data) chunks into upload operations. An operation is the
+# address and payload size it covers plus the lines to send, each of which the
+# bootrom acks with a sync symbol. If the bootrom's {commands} include fill,
+# all-zero pages become a single fill command, and if they include writez,
+# compressible chunks are sent zlib compressed. Operations are encoded lazily,
+# so an upload only holds the encoded form of those still in flight.
+def encode_ops(chunks, commands, page_size, level, stats):
+    for address, chunk in chunks:
+        stats["payload"] += len(chunk)
+        runs = [(0, len(chunk), False)]
+        if "fill" in commands:
+            runs = zero_runs(chunk, page_size)
+        for offset, size, is_zero in runs:
+            piece_addr = address + offset
+            if is_zero:
+                fill = f"fill {hex(piece_addr)} {hex(size)} 0x0\n"
+                yield (piece_addr, size, [fill.encode()])
+                continue
+            piece = chunk[offset:offset + size]
+            command = "write"
+            if "writez" in commands:
+                packed = zlib.compress(piece, level)
+                if len(packed) < len(piece):
+                    command = "writez"
+                    piece = packed
+            yield (piece_addr, size, [
+                f"{command} {hex(piece_addr)}\n".encode(),
+                binascii.b2a_base64(piece, newline=True)
+            ])
+
+
+class LinkStats:
+    """Counters, latency samples and trace events for the link to the
+    bootrom."""
+
+    max_trace_events = 100000
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.start = time.monotonic()
+        self.counters = collections.Counter()
+        self.samples = collections.defaultdict(list)
+        self.events = []
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def sample(self, name, seconds):
+        self.samples[name].append(seconds)
+
+    def trace(self, name, start, end, args=None):
+        if len(self.events) < self.max_trace_events:
+            self.events.append({
+                "name": name,
+                "ph": "X",
+                "ts": (start - self.start) * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": os.getpid(),
+                "tid": 0,
+                "args": args or {},
+            })
+
+    # Traces an interval that may overlap others, like a chunk in flight
+    def trace_async(self, name, start, end, ident):
+        if len(self.events) + 2 <= self.max_trace_events:
+            for phase, ts in (("b", start), ("e", end)):
+                self.events.append({
+                    "name": name,
+                    "cat": "chunk",
+                    "ph": phase,
+                    "id": ident,
+                    "ts": (ts - self.start) * 1e6,
+                    "pid": os.getpid(),
+                    "tid": 0,
+                })
+
+    @contextlib.contextmanager
+    def span(self, name, sample=None):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            end = time.monotonic()
+            self.trace(name, start, end)
+            if sample is not None:
+                self.sample(sample, end - start)
+
+    # Wraps {iterator}, adding the time spent producing items to {name}
+    def timed(self, iterator, name):
+        iterator = iter(iterator)
+        while True:
+            start = time.monotonic()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.counters[name] += time.monotonic() - start
+            yield item
+
+    def summary(self):
+        result = dict(self.counters)
+        result["elapsed_seconds"] = time.monotonic() - self.start
+        for name, samples in self.samples.items():
+            ordered = sorted(samples)
+            result[name] = {
+                "count": len(ordered),
+                "mean_ms": 1000 * sum(ordered) / len(ordered),
+                "p50_ms": 1000 * ordered[len(ordered) // 2],
+                "p90_ms": 1000 * ordered[int(len(ordered) * 0.9)],
+                "max_ms": 1000 * ordered[-1],
+            }
+        return result
+
+    def write_summary(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    # Writes the trace in Chrome's trace event format (chrome://tracing)
+    def write_trace(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
 
 class BootromShell(cmd.Cmd):
     intro = "Welcome to Bootrom Shell"
@@ -17,193 +276,731 @@ class BootromShell(cmd.Cmd):
     prompt = ""
     socket = None
     poller = None
-    pty_in = None
-    pty_out = None
+    pty_fd = None
     connected = False
     use_pty = False
+    # Serial device for use_pty, a simulator pty or a real UART. May be a glob
+    # like /dev/Nexus-*-FPGA-UART. A baud rate of None leaves the speed as is.
+    pty_path = "/tmp/uart"
+    baud_rate = None
     default_host_name = "Renode"
     default_host_addr = ("localhost", 31415)
-    default_max_retry = 60
+    # Deadlines in seconds for the socket to connect and for the bootrom to
+    # answer with a prompt. Both are polled with exponential backoff.
+    connect_timeout = 60.0
+    prompt_timeout = 180.0
+    # How long the line must stay quiet after the prompt before we start
+    # sending commands, so late answers to our pings aren't taken as acks.
+    settle_time = 0.1
+    latency_log_path = os.path.join(os.getenv("OUT", "/tmp"), "bootshell",
+                                    "connect_latency.jsonl")
+    # Number of write commands allowed in flight during an upload. A window of
+    # 1 falls back to the stop-and-wait protocol.
+    default_window = 8
+    window = default_window
+    chunk_size = 65536
+    max_retransmit = 3
+    # Incoming bytes are read a block at a time into a receive buffer that
+    # keeps anything past a sync symbol for the next response.
+    rx_block_size = 65536
+    rx_buffer = bytearray()
+    rx_view = memoryview(rx_buffer)
+    rx_head = 0
+    rx_tail = 0
+    # Page hashes of the last upload to each target, used to only send the
+    # pages that changed since then.
+    page_size = 4096
+    page_cache_path = os.path.join(os.getenv("OUT", "/tmp"), "bootshell",
+                                   "page_cache.json")
+    page_cache = None
+    use_page_cache = True
+    # Parsed ELF layouts, keyed by path, mtime and size
+    plan_cache_dir = os.path.join(os.getenv("OUT", "/tmp"), "bootshell",
+                                  "plans")
+    # Segments uploaded since we connected, trusted without asking the
+    # bootrom to hash them. Cleared whenever the target may have been reset.
+    session_segments = set()
+    remote_hash = None
+    # Remote commands that can't change target memory, all others clear the
+    # session's trusted segments.
+    read_only_commands = ("help", "hash", "echo")
+    # Transfer encoding. With "auto", all-zero pages are sent as fill commands
+    # and chunks are zlib compressed if the bootrom advertises fill/writez.
+    compression = "auto"
+    compression_level = 6
+    remote_command_set = None
+    upload_stats = {"payload": 0, "wire": 0}
+    total_stats = {"payload": 0, "wire": 0}
+    # In batch mode consecutive uploads are queued here and sent as a single
+    # pipelined stream by flush_uploads.
+    deferred_uploads = None
+    # Set by fail() so batch mode can tell whether a command succeeded
+    error = None
+    stats = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reset_rx()
+        self.reset_session()
+        self.upload_stats = {"payload": 0, "wire": 0}
+        self.total_stats = {"payload": 0, "wire": 0}
+        self.stats = LinkStats()
 
     ############################################################################
     # Network stuff here
 
-    # Try and connect to {host_addr} once per second for {max_retry} seconds
-    def connect(self, host_name, host_addr, max_retry):
+    # Try and connect to {host_addr} until {timeout} seconds have passed,
+    # backing off exponentially between attempts.
+    def connect(self, host_name, host_addr, timeout):
+        self.reset_rx()
+        self.reset_session()
         if self.use_pty:
-            # pylint: disable=R1732
-            self.pty_in = open("/tmp/uart", "rb", buffering=0)
-            self.pty_out = open("/tmp/uart", "wb", buffering=0)
-            self.poller = select.poll()
-            self.poller.register(self.pty_in, select.POLLIN)
-            return True
-        if self.socket is None:
-            print("Opening socket")
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            return self.connect_pty(timeout)
 
         print(f"Connecting to {host_name}", end="")
-        for _ in range(max_retry):
+        deadline = time.monotonic() + timeout
+        for delay in backoff(deadline):
             try:
-                self.socket.connect(host_addr)
+                self.socket = socket.create_connection(
+                    host_addr, timeout=max(deadline - time.monotonic(), 0.01))
+                self.socket.settimeout(None)
+                # Commands are small and latency bound, don't let Nagle hold
+                # them back waiting for an ack.
+                self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY,
+                                       1)
                 self.connected = True
                 self.poller = select.poll()
                 self.poller.register(self.socket, select.POLLIN)
                 print("Connected!")
                 return True
-            except ConnectionError:
-                print(".", end="")
-                sys.stdout.flush()
-                time.sleep(1)
+            except OSError:
+                if delay >= 0.5:
+                    print(".", end="")
+                    sys.stdout.flush()
+                time.sleep(delay)
         print("Connection timed out!")
         return False
 
+    # Opens {pty_path} non-blocking and puts it in raw mode, retrying until
+    # {timeout} seconds have passed for devices that haven't appeared yet.
+    def connect_pty(self, timeout):
+        print(f"Opening {self.pty_path}", end="")
+        deadline = time.monotonic() + timeout
+        for delay in backoff(deadline):
+            paths = sorted(glob.glob(self.pty_path)) or [self.pty_path]
+            try:
+                fd = os.open(paths[0], os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+            except OSError:
+                if delay >= 0.5:
+                    print(".", end="")
+                    sys.stdout.flush()
+                time.sleep(delay)
+                continue
+            try:
+                self.configure_tty(fd)
+            except (termios.error, AttributeError) as e:
+                os.close(fd)
+                print(f"\n{paths[0]} is not a usable serial device: {e}")
+                return False
+            self.pty_fd = fd
+            self.pty_path = paths[0]
+            self.connected = True
+            self.poller = select.poll()
+            self.poller.register(fd, select.POLLIN)
+            print(" Opened!")
+            return True
+        print(" Timed out!")
+        return False
+
+    def configure_tty(self, fd):
+        tty.setraw(fd, termios.TCSANOW)
+        attrs = termios.tcgetattr(fd)
+        attrs[2] |= termios.CLOCAL | termios.CREAD
+        if self.baud_rate is not None:
+            speed = getattr(termios, f"B{self.baud_rate}")
+            attrs[4] = speed
+            attrs[5] = speed
+        termios.tcsetattr(fd, termios.TCSANOW, attrs)
+        termios.tcflush(fd, termios.TCIOFLUSH)
+
+    # Pings the bootrom with newlines, backing off exponentially, until it
+    # answers with a sync symbol or {timeout} seconds have passed. Then turns
+    # remote echo off and waits for the line to settle.
+    def wait_for_prompt(self, timeout):
+        deadline = time.monotonic() + timeout
+        for delay in backoff(deadline):
+            if not self.connected:
+                return False
+            self.send("\n".encode())
+            if self.wait_for_sync(max(1, int(delay * 1000))):
+                # Sync seen, turn remote echo off and mute the ack
+                self.send("echo off\n".encode())
+                self.wait_for_sync(1000, False)
+                self.wait_for_idle(int(self.settle_time * 1000), False)
+                return True
+        return False
+
+    def renode_version(self):
+        tag_file = os.path.join(os.getenv("OUT", "/tmp"), "host", "renode",
+                                "tag")
+        try:
+            with open(tag_file, "r", encoding="utf-8") as f:
+                return f.readline().strip()
+        except OSError:
+            return "unknown"
+
+    def log_connect_latency(self, connect_time, prompt_time):
+        record = {
+            "time": time.time(),
+            "target": self.target_key(),
+            "renode": self.renode_version(),
+            "connect": connect_time,
+            "prompt": prompt_time,
+        }
+        try:
+            os.makedirs(os.path.dirname(self.latency_log_path), exist_ok=True)
+            with open(self.latency_log_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+        except OSError as e:
+            print(f"Could not log connect latency: {e}")
+
     def disconnect(self):
-        if self.pty_in is not None:
-            print("Closing pty_in")
-            self.pty_in.close()
-        if self.pty_out is not None:
-            print("Closing pty_in")
-            self.pty_out.close()
+        if self.pty_fd is not None:
+            print(f"Closing {self.pty_path}")
+            os.close(self.pty_fd)
         if self.socket is not None:
             print("Closing socket")
             self.socket.close()
         self.connected = False
-        self.pty_in = None
-        self.pty_out = None
+        self.pty_fd = None
         self.socket = None
         self.poller = None
+        self.reset_rx()
 
     def getpeername(self):
         if self.use_pty:
-            return "/tmp/uart"
+            return self.pty_path
         return self.socket.getpeername()
 
     def send(self, data):
+        self.stats.count("bytes_sent", len(data))
         if self.use_pty:
-            self.pty_out.write(data)
-            self.pty_out.flush()
+            self.write_pty([data])
         else:
-            self.socket.send(data)
+            self.socket.sendall(data)
 
-    def recv(self, size):
+    # Writes {buffers} to the non-blocking pty, waiting for the device to
+    # drain whenever its output queue is full.
+    def write_pty(self, buffers):
+        buffers = [memoryview(buffer) for buffer in buffers]
+        writable = select.poll()
+        writable.register(self.pty_fd, select.POLLOUT)
+        while buffers:
+            try:
+                written = os.writev(self.pty_fd, buffers)
+            except BlockingIOError:
+                writable.poll(1000)
+                continue
+            while buffers and written >= len(buffers[0]):
+                written -= len(buffers.pop(0))
+            if written:
+                buffers[0] = buffers[0][written:]
+
+    def recv_into(self, view):
         if self.use_pty:
-            print(self.pty_in)
-            result = self.pty_in.read(size)
+            try:
+                count = os.readv(self.pty_fd, [view])
+            except BlockingIOError:
+                count = 0
+            except OSError as e:
+                # The other end of a pty going away shows up as EIO
+                if e.errno != errno.EIO:
+                    raise
+                self.disconnect()
+                count = 0
         else:
-            result = self.socket.recv(size)
-            if len(result) == 0:
+            count = self.socket.recv_into(view)
+            if count == 0:
                 self.disconnect()
-        return result
+        self.stats.count("bytes_received", count)
+        return count
 
     def poll(self, timeout):
         if self.connected:
+            start = time.monotonic()
             poll_result = self.poller.poll(timeout)
+            self.stats.count("polls")
+            self.stats.count("poll_seconds", time.monotonic() - start)
             return len(poll_result) != 0
         return False
 
     ############################################################################
 
+    def reset_rx(self):
+        self.rx_buffer = bytearray(4 * self.rx_block_size)
+        self.rx_view = memoryview(self.rx_buffer)
+        self.rx_head = 0
+        self.rx_tail = 0
+
+    def rx_pending(self):
+        return self.rx_tail > self.rx_head
+
+    # Reads the next block from the line into the receive buffer. Returns False
+    # if nothing arrived within {timeout}.
+    def fill_rx(self, timeout):
+        if not self.poll(timeout):
+            return False
+        if self.rx_head == self.rx_tail:
+            self.rx_head = 0
+            self.rx_tail = 0
+        elif len(self.rx_buffer) - self.rx_tail < self.rx_block_size:
+            # Move the unread bytes back to the front, growing the buffer if
+            # they would not leave room for another block.
+            pending = self.rx_tail - self.rx_head
+            if pending + self.rx_block_size > len(self.rx_buffer):
+                buffer = bytearray(2 * (pending + self.rx_block_size))
+                buffer[:pending] = self.rx_view[self.rx_head:self.rx_tail]
+                self.rx_view.release()
+                self.rx_buffer = buffer
+                self.rx_view = memoryview(buffer)
+            else:
+                unread = self.rx_view[self.rx_head:self.rx_tail]
+                self.rx_view[:pending] = unread
+            self.rx_head = 0
+            self.rx_tail = pending
+        end = self.rx_tail + self.rx_block_size
+        count = self.recv_into(self.rx_view[self.rx_tail:end])
+        self.rx_tail += count
+        return count != 0
+
+    # Removes buffered bytes up to and including the next sync symbol. Returns
+    # the bytes before it and whether a sync symbol was seen.
+    def take_rx(self):
+        end = self.rx_buffer.find(curses.ascii.ETX, self.rx_head, self.rx_tail)
+        saw_sync = end >= 0
+        if not saw_sync:
+            end = self.rx_tail
+        data = bytes(self.rx_view[self.rx_head:end])
+        self.rx_head = end + 1 if saw_sync else end
+        return data, saw_sync
+
     # Dumps incoming packet to the console, returns true if it contained a sync
-    # symbol
-    def print_packet(self, echo=False):
-        saw_sync = False
-        received = self.recv(4096)
-        for c in received:
-            if c == curses.ascii.ETX:
-                saw_sync = True
-            elif echo:
-                sys.stdout.write(chr(c))
+    # symbol. Bytes after the sync symbol stay buffered. The packet is also
+    # appended to {response} if given.
+    def print_packet(self, echo=False, response=None):
+        if not self.rx_pending():
+            self.fill_rx(0)
+        data, saw_sync = self.take_rx()
+        if response is not None:
+            response += data
+        if echo and data:
+            sys.stdout.write(data.decode("latin-1"))
         sys.stdout.flush()
         return saw_sync
 
     # Waits until we see a packet containing a sync symbol or the line has been
-    # idle for {timeout}
-    def wait_for_sync(self, timeout, echo=True):
+    # idle for {timeout}, collecting what was received in {response}
+    def wait_for_sync(self, timeout, echo=True, response=None):
         while True:
             if not self.connected:
                 return False
-            if self.poll(timeout):
-                if self.print_packet(echo):
+            if self.rx_pending() or self.fill_rx(timeout):
+                if self.print_packet(echo, response):
                     return True
             else:
                 return False
 
-    # Collects bytes in a string until we see a sync symbol or we timeout
+    # Collects bytes in a string until we see a sync symbol or we timeout.
+    # Returns None on timeout.
     def wait_for_response(self, timeout):
         result = bytearray()
         while True:
-            if self.poll(timeout):
-                received = self.recv(1)
-                if received[0] == curses.ascii.ETX:
+            if self.rx_pending() or self.fill_rx(timeout):
+                data, saw_sync = self.take_rx()
+                result += data
+                if saw_sync:
                     return result
-                result.append(received[0])
             else:
                 print("Timeout while waiting for command response")
-                return b""
+                return None
 
     # Waits until the line has been idle for {timeout}
     def wait_for_idle(self, timeout, echo=True):
-        while True:
-            if self.poll(timeout):
-                self.print_packet(echo)
-            else:
-                break
+        while self.rx_pending() or self.fill_rx(timeout):
+            self.print_packet(echo)
+
+    def fail(self, message):
+        print(message)
+        self.error = message
+        return False
 
     def run_command(self, line):
         if self.connected:
-            self.send((line + "\n").encode())
-            self.wait_for_sync(100000)
-        else:
-            print("Not connected!")
+            response = bytearray()
+            with self.stats.span(line, sample="command_rtt"):
+                self.send((line + "\n").encode())
+                synced = self.wait_for_sync(100000, response=response)
+            if not synced:
+                return self.fail(f"No response to '{line}'")
+            for reply in response.decode(errors="replace").splitlines():
+                if reply.strip().lower().startswith("error"):
+                    return self.fail(f"'{line}' failed: {reply.strip()}")
+            return True
+        return self.fail("Not connected!")
 
     ############################################################################
 
+    def chunk_blob(self, blob, address):
+        return split_chunks(blob, address, self.chunk_size)
+
+    # Asks the bootrom for its command list, once per session
+    def remote_commands(self):
+        if self.remote_command_set is None:
+            self.send("help\n".encode())
+            response = self.wait_for_response(100000) or b""
+            self.remote_command_set = {
+                line.split()[0].decode(errors="replace")
+                for line in response.splitlines() if line.strip()
+            }
+        return self.remote_command_set
+
+    # Turns (address, data) chunks into upload operations, using fill and
+    # writez when compression is enabled and the bootrom supports them.
+    def upload_ops(self, chunks):
+        commands = set()
+        if self.compression != "off":
+            commands = self.remote_commands()
+        return self.stats.timed(
+            encode_ops(chunks, commands, self.page_size,
+                       self.compression_level, self.upload_stats),
+            "encode_seconds")
+
+    # Sends a list of buffers without joining them into one copy first
+    def send_lines(self, lines):
+        self.upload_stats["wire"] += sum(len(line) for line in lines)
+        self.stats.count("bytes_sent", sum(len(line) for line in lines))
+        if self.use_pty:
+            self.write_pty(lines)
+            return
+        lines = [memoryview(line) for line in lines]
+        while lines:
+            sent = self.socket.sendmsg(lines)
+            while lines and sent >= len(lines[0]):
+                sent -= len(lines.pop(0))
+            if sent:
+                lines[0] = lines[0][sent:]
+
+    # Reads {count} responses from the bootrom. Returns True if all of them
+    # were acked, False if the bootrom reported an error and None if we lost
+    # sync with the bootrom. All {count} responses are read even after an
+    # error so the next operation's acks aren't taken from this one.
+    def wait_for_acks(self, count, timeout=100000):
+        acked = True
+        for _ in range(count):
+            response = self.wait_for_response(timeout)
+            if response is None:
+                return None
+            if b"error" in response.lower():
+                print(response.decode(errors="replace").strip())
+                acked = False
+        return acked
+
+    # Runs a single operation with the stop-and-wait protocol, retransmitting
+    # it up to {max_retransmit} times.
+    def run_op(self, op):
+        address, _, lines = op
+        for _ in range(self.max_retransmit + 1):
+            for line in lines:
+                start = time.monotonic()
+                self.send_lines([line])
+                acked = self.wait_for_acks(1)
+                self.stats.sample("ack_latency", time.monotonic() - start)
+                if not acked:
+                    break
+            else:
+                return True
+            self.stats.count("retransmits")
+            if acked is None:
+                self.wait_for_idle(100, False)
+            print(f"Retransmitting chunk at {hex(address)}")
+        print(f"Failed to write chunk at {hex(address)}")
+        return False
+
+    # Raw upload. Whatever the page cache knew about the range is stale once
+    # it has been written, whether or not the write succeeded. It is dropped
+    # both when the upload is queued, so later segments queued in batch mode
+    # don't diff against it, and once it is sent, in case a segment queued
+    # before it recorded the range in the meantime.
     def load_blob_at(self, blob, address):
-        chunks = [blob[i:i + 65536] for i in range(0, len(blob), 65536)]
-        for chunk in chunks:
-            self.send(f"write {hex(address)}\n".encode())
-            self.wait_for_response(100000)
-            self.send(base64.b64encode(chunk))
-            self.send("\n".encode())
-            self.wait_for_sync(100000)
-            address = address + 65536
+        self.invalidate_range(address, len(blob))
+        return self.load_chunks(
+            self.chunk_blob(blob, address),
+            lambda _: self.invalidate_range(address, len(blob)))
+
+    # Uploads a list of (address, data) chunks and calls {done} with the
+    # result. While uploads are deferred the chunks are only queued.
+    def load_chunks(self, chunks, done=None):
+        if self.deferred_uploads is not None:
+            self.deferred_uploads.append((chunks, done))
+            return True
+        ok = self.transfer_chunks(chunks)
+        if done is not None:
+            done(ok)
+        return ok
+
+    # Sends all queued uploads as one stream
+    def flush_uploads(self):
+        if not self.deferred_uploads:
+            return True
+        deferred = self.deferred_uploads
+        self.deferred_uploads = []
+        ok = self.transfer_chunks(
+            itertools.chain.from_iterable(chunks for chunks, _ in deferred))
+        for _, done in deferred:
+            if done is not None:
+                done(ok)
+        return ok
+
+    def transfer_chunks(self, chunks):
+        self.upload_stats = {"payload": 0, "wire": 0}
+        with self.stats.span("upload", sample="upload"):
+            if self.window <= 1:
+                ok = self.load_chunks_stop_and_wait(chunks)
+            else:
+                ok = self.load_chunks_pipelined(chunks)
+        self.total_stats["payload"] += self.upload_stats["payload"]
+        self.total_stats["wire"] += self.upload_stats["wire"]
+        if not ok:
+            self.fail("Upload failed")
+        return ok
+
+    def load_chunks_stop_and_wait(self, chunks):
+        for op in self.upload_ops(chunks):
+            if not self.run_op(op):
+                return False
+        return True
+
+    # Streams operations back-to-back, keeping up to {window} of them
+    # unacknowledged. Operations the bootrom rejected are resent with the
+    # stop-and-wait protocol once the pipeline has drained.
+    def load_chunks_pipelined(self, chunks):
+        ops = self.upload_ops(chunks)
+        in_flight = collections.deque()
+        retry = []
+        op = next(ops, None)
+        while op is not None or in_flight:
+            if op is not None and len(in_flight) < self.window:
+                self.send_lines(op[2])
+                in_flight.append((op, time.monotonic()))
+                op = next(ops, None)
+                continue
+
+            done, sent = in_flight.popleft()
+            acked = self.wait_for_acks(len(done[2]))
+            now = time.monotonic()
+            self.stats.sample("ack_latency", now - sent)
+            self.stats.trace_async(f"chunk {hex(done[0])}", sent, now, done[0])
+            if acked is None:
+                # We no longer know which response belongs to which operation,
+                # so drain the line and resend everything not yet acknowledged.
+                print("Lost sync with bootrom, falling back to stop-and-wait")
+                self.wait_for_idle(100, False)
+                retry.append(done)
+                retry.extend(op for op, _ in in_flight)
+                self.stats.count("retransmits", 1 + len(in_flight))
+                # The next op was never sent, so it isn't a retransmit
+                if op is not None:
+                    retry.append(op)
+                break
+            if not acked:
+                self.stats.count("retransmits")
+                retry.append(done)
+
+        for op in itertools.chain(retry, ops):
+            if not self.run_op(op):
+                return False
+        return True
 
     def load_file_at(self, filename, address):
         try:
             with open(filename, "rb") as file:
                 print("file opened")
-                blob = file.read()
-                print("blob read")
-                self.load_blob_at(blob, address)
+                return self.load_blob_at(map_file(file), address)
         except OSError as e:
             print(f"Could not load {filename}")
-            print(f"Exception {e}   ")
+            return self.fail(f"Exception {e}   ")
 
     def load_elf(self, filename):
         try:
-            # pylint: disable=R1732
-            elf_file = ELFFile(open(filename, "rb"))
-            print(f"Entry point at {hex(elf_file.header.e_entry)}")
-            return elf_file
-        except OSError:
-            print(f"Could not open '{filename}' as an ELF file")
+            plan = load_upload_plan(filename, self.plan_cache_dir,
+                                    self.page_size)
+            print(f"Entry point at {hex(plan['entry'])}")
+            return plan
+        except (OSError, ELFError):
+            self.fail(f"Could not open '{filename}' as an ELF file")
+            return None
+
+    ############################################################################
+    # Differential uploads
+
+    def reset_session(self):
+        self.session_segments = set()
+        self.remote_hash = None
+        self.remote_command_set = None
+
+    # Forgets cached segments overlapping {size} bytes at {address}
+    def invalidate_range(self, address, size):
+        if not self.connected:
+            # The next session hashes segments before trusting them anyway
+            return
+        cache = self.load_page_cache()
+        stale = []
+        for key, entry in cache.items():
+            start = int(key, 16)
+            if start < address + size and address < start + entry["size"]:
+                stale.append(key)
+        for key in stale:
+            del cache[key]
+            self.session_segments.discard(int(key, 16))
+        if stale:
+            self.save_page_cache()
+
+    def target_key(self):
+        peer = self.getpeername()
+        if isinstance(peer, tuple):
+            return f"{peer[0]}:{peer[1]}"
+        return peer
+
+    def load_page_cache(self):
+        if self.page_cache is None:
+            try:
+                with open(self.page_cache_path, "r", encoding="utf-8") as f:
+                    self.page_cache = json.load(f)
+            except (OSError, ValueError):
+                self.page_cache = {}
+        return self.page_cache.setdefault(self.target_key(), {})
+
+    def save_page_cache(self):
+        try:
+            os.makedirs(os.path.dirname(self.page_cache_path), exist_ok=True)
+            tmp_path = f"{self.page_cache_path}.{os.getpid()}"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.page_cache, f)
+            os.replace(tmp_path, self.page_cache_path)
+        except OSError as e:
+            print(f"Could not save page cache: {e}")
+
+    # Asks the bootrom for the CRC32 of {size} bytes at {address}. Returns None
+    # if the bootrom doesn't support the hash command.
+    def remote_crc32(self, address, size):
+        if self.remote_hash is False:
+            return None
+        self.send(f"hash {hex(address)} {hex(size)}\n".encode())
+        response = self.wait_for_response(100000)
+        try:
+            token = response.split()[-1]
+            if not token.startswith(b"0x"):
+                raise ValueError(token)
+            result = int(token, 16)
+        except (AttributeError, IndexError, ValueError):
+            print("Bootrom has no hash command, page cache limited to the "
+                  "current session")
+            self.remote_hash = False
             return None
+        self.remote_hash = True
+        return result
+
+    # Checks that the target still holds what we last uploaded to {address}
+    def cached_segment_valid(self, address, entry):
+        if address in self.session_segments:
+            return True
+        if self.remote_crc32(address, entry["size"]) == entry["crc32"]:
+            self.session_segments.add(address)
+            return True
+        return False
+
+    # Uploads a segment, sending only the pages that changed since the last
+    # upload to the same target and address. {pages} are the segment's page
+    # hashes if they are already known.
+    def load_segment(self, data, address, pages=None):
+        if not self.use_page_cache:
+            return self.load_blob_at(data, address)
+
+        cache = self.load_page_cache()
+        entry = cache.pop(hex(address), None)
+        if pages is None:
+            pages = page_hashes(data, self.page_size)
+        if entry is None or not self.cached_segment_valid(address, entry):
+            chunks = self.chunk_blob(data, address)
+        else:
+            old_pages = entry["pages"]
+            chunks = []
+            changed = 0
+            run_start = None
+            for index, page in enumerate(pages + [None]):
+                dirty = (page is not None and
+                         (index >= len(old_pages) or old_pages[index] != page))
+                if dirty:
+                    changed += 1
+                    if run_start is None:
+                        run_start = index * self.page_size
+                elif run_start is not None:
+                    run_end = min(index * self.page_size, len(data))
+                    chunks += self.chunk_blob(data[run_start:run_end],
+                                              address + run_start)
+                    run_start = None
+            print(f"  {changed} of {len(pages)} pages changed")
 
-    def upload_elf(self, elf_file):
-        if elf_file is None:
+        # Forget the entry while the upload is in progress so an interrupted
+        # upload can't leave a stale cache behind.
+        self.save_page_cache()
+
+        def done(ok):
+            if not ok:
+                self.session_segments.discard(address)
+                return
+            cache[hex(address)] = {
+                "size": len(data),
+                "crc32": zlib.crc32(data),
+                "pages": pages,
+            }
+            self.session_segments.add(address)
+            self.save_page_cache()
+
+        return self.load_chunks(chunks, done)
+
+    def upload_elf(self, plan):
+        if plan is None:
             print("No elf file")
             return False
-        for segment in elf_file.iter_segments():
-            header = segment.header
-            if header.p_type == "PT_LOAD":
-                start = header.p_paddr
-                size = header.p_filesz
-                end = start + size
-                print(
-                    f"Loading seg: {hex(start)}:{hex(end)} ({size} bytes)...")
-                sys.stdout.flush()
-                self.load_blob_at(segment.data(), start)
+        start_time = time.monotonic()
+        total = 0
+        wire = self.total_stats["wire"]
+        with open(plan["path"], "rb") as file:
+            stat = os.fstat(file.fileno())
+            if (stat.st_mtime_ns, stat.st_size) != (plan["mtime_ns"],
+                                                    plan["size"]):
+                return self.fail(f"{plan['path']} changed since it was parsed")
+            mapping = map_file(file)
+        for segment in plan["segments"]:
+            start = segment["paddr"]
+            size = segment["filesz"]
+            end = start + size
+            print(f"Loading seg: {hex(start)}:{hex(end)} ({size} bytes)...")
+            sys.stdout.flush()
+            data = segment_view(mapping, segment["offset"], size)
+            if not self.load_segment(data, start, segment["pages"]):
+                return False
+            total += size
 
+        if self.deferred_uploads is not None:
+            print(f"Queued {total} bytes")
+            return True
+        elapsed = time.monotonic() - start_time
+        wire = self.total_stats["wire"] - wire
+        print(f"Uploaded {total} bytes in {elapsed:.2f}s "
+              f"({total / max(elapsed, 1e-6) / 1024:.1f} KiB/s), "
+              f"{wire} bytes on the wire")
         return True
 
     ############################################################################
@@ -213,32 +1010,46 @@ class BootromShell(cmd.Cmd):
         """Connects to the Renode server, localhost@31415 by default."""
         host_name = self.default_host_name
         host_addr = self.default_host_addr
-        max_retry = self.default_max_retry
 
-        if self.connect(host_name, host_addr, max_retry):
+        start = time.monotonic()
+        if self.connect(host_name, host_addr, self.connect_timeout):
             print(f"Connected to {host_name} @ {self.getpeername()}")
         else:
-            print(
-                f"Failed to connect to {host_name} after {max_retry} seconds")
+            print(f"Failed to connect to {host_name} after "
+                  f"{self.connect_timeout} seconds")
             self.disconnect()
             return
+        connect_time = time.monotonic() - start
 
-        # Ping the server with a newline once per second until we see a sync
-        # symbol and the line goes idle for 100 msec.
         print("Waiting for prompt...")
-        for _ in range(180):
-            if not self.connected:
-                break
-            self.send("\n".encode())
-            if self.wait_for_sync(1000):
-                # Sync seen, turn remote echo off and mute the ack
-                self.send("echo off\n".encode())
-                self.wait_for_idle(1000, False)
-                return
+        if not self.wait_for_prompt(self.prompt_timeout):
+            print("Did not see command prompt from server")
+            self.disconnect()
+            return
+        prompt_time = time.monotonic() - start
+        self.stats.trace("connect", start, start + prompt_time)
+        self.stats.sample("connect_to_prompt", prompt_time)
+        print(f"Prompt after {prompt_time * 1000:.0f} ms")
+        self.log_connect_latency(connect_time, prompt_time)
 
-        print("Did not see command prompt from server")
-        self.disconnect()
-        return
+    def do_connect_stats(self, _=""):
+        """Shows a histogram of connect-to-prompt latency per Renode version"""
+        histograms = collections.defaultdict(collections.Counter)
+        try:
+            with open(self.latency_log_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    record = json.loads(line)
+                    bucket = 1
+                    while bucket < record["prompt"] * 1000:
+                        bucket *= 2
+                    histograms[record["renode"]][bucket] += 1
+        except (OSError, ValueError) as e:
+            print(f"Could not read {self.latency_log_path}: {e}")
+            return
+        for version, histogram in sorted(histograms.items()):
+            print(f"{version}:")
+            for bucket, count in sorted(histogram.items()):
+                print(f"  <= {bucket:>7} ms {count:>5} {'#' * min(count, 50)}")
 
     def do_disconnect(self, _=""):
         """Disconnect from the Renode server"""
@@ -256,21 +1067,22 @@ class BootromShell(cmd.Cmd):
         try:
             e = self.load_elf(line)
             if e is None:
-                print(f"Could not open '{line}' as an ELF file")
                 return False
 
-            self.upload_elf(e)
-            self.send(f"boot {hex(e.header.e_entry)}\n".encode())
+            if not self.upload_elf(e) or not self.flush_uploads():
+                self.fail(f"Failed to upload {line}")
+                return False
+            self.reset_session()
+            self.send(f"boot {hex(e['entry'])}\n".encode())
             self.wait_for_sync(100000)
         except OSError:
-            print(f"Failed to boot {line}")
+            self.fail(f"Failed to boot {line}")
         return True
 
     def do_load_elf(self, line=""):
         """Load local ELF file to remote device"""
         e = self.load_elf(line)
         if e is None:
-            print(f"Could not open '{line}' as an ELF file")
             return False
 
         self.upload_elf(e)
@@ -281,21 +1093,113 @@ class BootromShell(cmd.Cmd):
         args = line.split()
         self.load_file_at(args[0], int(args[1], 16))
 
+    def do_window(self, line=""):
+        """Sets the number of write commands kept in flight during uploads.
+        A window of 1 uses the stop-and-wait protocol."""
+        if line:
+            self.window = max(1, int(line, 0))
+        print(f"Upload window: {self.window}")
+
+    def do_page_cache(self, line=""):
+        """Controls differential uploads: page_cache [on|off|clear]
+        With the cache on, only pages that changed since the last upload to
+        this target are sent."""
+        if line == "on":
+            self.use_page_cache = True
+        elif line == "off":
+            self.use_page_cache = False
+        elif line == "clear":
+            self.page_cache = {}
+            self.reset_session()
+            self.save_page_cache()
+        state = "on" if self.use_page_cache else "off"
+        print(f"Page cache: {state} ({self.page_cache_path})")
+
+    def do_compression(self, line=""):
+        """Controls compressed uploads: compression [auto|off]
+        Also reports wire bytes vs. payload bytes of the last upload."""
+        if line in ("auto", "off"):
+            self.compression = line
+        print(f"Compression: {self.compression}")
+        for name, stats in (("last upload", self.upload_stats),
+                            ("total", self.total_stats)):
+            ratio = stats["wire"] / max(stats["payload"], 1)
+            print(f"  {name}: {stats['payload']} payload bytes, "
+                  f"{stats['wire']} wire bytes ({ratio:.2f}x)")
+
+    def do_stats(self, line=""):
+        """Shows link statistics: stats [reset|json FILE|trace FILE]
+        'json' writes the counters and latencies, 'trace' writes a Chrome
+        trace (chrome://tracing) of commands and chunks."""
+        args = line.split()
+        if args == ["reset"]:
+            self.stats.reset()
+            return
+        if len(args) == 2 and args[0] in ("json", "trace"):
+            try:
+                if args[0] == "json":
+                    self.stats.write_summary(args[1])
+                else:
+                    self.stats.write_trace(args[1])
+            except OSError as e:
+                self.fail(f"Could not write {args[1]}: {e}")
+            return
+        for name, value in sorted(self.stats.summary().items()):
+            if isinstance(value, dict):
+                print(f"{name}: {value['count']} samples, "
+                      f"mean {value['mean_ms']:.2f} ms, "
+                      f"p50 {value['p50_ms']:.2f} ms, "
+                      f"p90 {value['p90_ms']:.2f} ms, "
+                      f"max {value['max_ms']:.2f} ms")
+            elif isinstance(value, float):
+                print(f"{name}: {value:.3f}")
+            else:
+                print(f"{name}: {value}")
+
     def do_load_xflash(self, line):
         """Uploads a binary file to external flash"""
-        self.load_file_at(line, "0x44000000")
+        self.load_file_at(line, 0x44000000)
 
     def do_boot_sec(self, line):
         """Boots an app on SEC at the given entry point.
         This will kill the active bootrom console session."""
+        self.reset_session()
         self.send(f"boot {line}\n".encode())
         self.wait_for_idle(100)
 
     def do_boot_smc(self, line):
         """Boots an app on SMC at the given entry point.
         If entry == 0, will stop SMC."""
-        self.send(f"poked 0x54020000 {line}")
-        self.wait_for_idle(100)
+        self.session_segments = set()
+        self.run_command(f"poked 0x54020000 {line}")
+
+    def do_expect(self, line=""):
+        """Echoes target output until it matches a regex:
+        expect REGEX [TIMEOUT [FAIL_REGEX]]
+        Fails after TIMEOUT seconds (default 60) or on a FAIL_REGEX match."""
+        args = shlex.split(line)
+        if not args:
+            return self.fail("Usage: expect REGEX [TIMEOUT [FAIL_REGEX]]")
+        expects = [Expect("expect", args[0], "pass")]
+        if len(args) > 2:
+            expects.append(Expect("fail", args[2], "fail"))
+        expect = UartExpect(expects, float(args[1]) if len(args) > 1 else 60)
+        result = None
+        while result is None:
+            if self.rx_pending():
+                data = bytes(self.rx_view[self.rx_head:self.rx_tail])
+                self.rx_head = self.rx_tail
+                sys.stdout.write(data.decode("latin-1"))
+                sys.stdout.flush()
+                result = expect.feed(data)
+            elif not self.connected:
+                result = expect.finish("eof")
+            else:
+                self.fill_rx(expect.remaining() * 1000)
+                result = expect.check()
+        if not result.ok:
+            self.fail(f"expect {args[0]!r}: {result.status} {result.detail}")
+        return False
 
     ##----------------------------------------
 
@@ -316,6 +1220,10 @@ class BootromShell(cmd.Cmd):
     ##----------------------------------------
 
     def default(self, line):
+        # Raw commands may write memory behind the page cache's back, so
+        # segments have to be hashed again before they are trusted.
+        if line.split()[0] not in self.read_only_commands:
+            self.session_segments = set()
         self.run_command(line)
 
     def emptyline(self):
@@ -337,10 +1245,422 @@ class BootromShell(cmd.Cmd):
 
 
 ################################################################################
+# Fleet mode: boot one ELF on many targets concurrently
+
+
+# Reads the PT_LOAD segments of {filename} through the upload plan cache.
+# Returns the entry point and a list of (address, data) pairs.
+def read_elf_segments(filename):
+    plan = load_upload_plan(filename, BootromShell.plan_cache_dir,
+                            BootromShell.page_size)
+    with open(plan["path"], "rb") as file:
+        mapping = map_file(file)
+    segments = [(segment["paddr"],
+                 segment_view(mapping, segment["offset"], segment["filesz"]))
+                for segment in plan["segments"]]
+    return plan["entry"], segments
+
+
+class AsyncBootromLink:
+    """Asyncio connection to a single bootrom, speaking the same protocol as
+    BootromShell."""
+
+    response_timeout = 100.0
+
+    def __init__(self, host, port, window):
+        self.host = host
+        self.port = port
+        self.window = window
+        self.reader = None
+        self.writer = None
+        self.stats = {"payload": 0, "wire": 0}
+
+    async def connect(self, deadline):
+        for delay in backoff(deadline):
+            try:
+                self.reader, self.writer = await asyncio.open_connection(
+                    self.host, self.port, limit=1 << 20)
+                sock = self.writer.get_extra_info("socket")
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                return True
+            except OSError:
+                await asyncio.sleep(delay)
+        return False
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+    def send(self, data):
+        self.stats["wire"] += len(data)
+        self.writer.write(data)
+
+    # Returns the next response without its sync symbol, or None on timeout
+    async def response(self, timeout=None):
+        try:
+            data = await asyncio.wait_for(
+                self.reader.readuntil(bytes([curses.ascii.ETX])), timeout
+                or self.response_timeout)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+            return None
+        return data[:-1]
+
+    async def wait_for_idle(self, timeout):
+        while True:
+            try:
+                data = await asyncio.wait_for(self.reader.read(65536), timeout)
+            except asyncio.TimeoutError:
+                return
+            if not data:
+                return
+
+    # Pings the bootrom with a newline until it answers, then turns remote echo
+    # off and discards any late answers so they aren't taken as acks.
+    async def sync(self, deadline):
+        for delay in backoff(deadline):
+            self.send(b"\n")
+            if await self.response(max(delay, 0.001)) is not None:
+                self.send(b"echo off\n")
+                await self.wait_for_idle(BootromShell.settle_time)
+                return True
+        return False
+
+    async def remote_commands(self):
+        self.send(b"help\n")
+        response = await self.response() or b""
+        return {
+            line.split()[0].decode(errors="replace")
+            for line in response.splitlines() if line.strip()
+        }
+
+    # Reads the acks for {op}. Returns True if all lines were acked, False if
+    # the bootrom reported an error.
+    async def wait_for_acks(self, op):
+        acked = True
+        for _ in op[2]:
+            response = await self.response()
+            if response is None:
+                raise ConnectionError(f"lost sync at {hex(op[0])}")
+            if b"error" in response.lower():
+                acked = False
+        return acked
+
+    async def run_op(self, op):
+        for _ in range(BootromShell.max_retransmit + 1):
+            for line in op[2]:
+                self.send(line)
+                response = await self.response()
+                if response is None:
+                    raise ConnectionError(f"lost sync at {hex(op[0])}")
+                if b"error" in response.lower():
+                    break
+            else:
+                return True
+        return False
+
+    # Sends {ops} keeping up to {window} of them in flight, then retries any
+    # the bootrom rejected one at a time.
+    async def upload(self, ops):
+        window = asyncio.Semaphore(self.window)
+        in_flight = asyncio.Queue()
+
+        async def sender():
+            for op in ops:
+                await window.acquire()
+                self.stats["payload"] += op[1]
+                self.send(b"".join(op[2]))
+                in_flight.put_nowait(op)
+                await self.writer.drain()
+            in_flight.put_nowait(None)
+
+        sender_task = asyncio.create_task(sender())
+        failed = []
+        try:
+            while (op := await in_flight.get()) is not None:
+                if not await self.wait_for_acks(op):
+                    failed.append(op)
+                window.release()
+            await sender_task
+        finally:
+            sender_task.cancel()
+
+        for op in failed:
+            if not await self.run_op(op):
+                return False
+        return True
+
+    async def boot(self, entry):
+        self.send(f"boot {hex(entry)}\n".encode())
+        await self.writer.drain()
+
+
+async def boot_target(host, port, entry, encoded, encode, args):
+    link = AsyncBootromLink(host, port, args.window)
+    result = {"target": f"{host}:{port}", "ok": False}
+    start = time.monotonic()
+    try:
+        if not await link.connect(start + args.connect_timeout):
+            result["error"] = "connect timed out"
+            return result
+        result["connect"] = time.monotonic() - start
+        if not await link.sync(time.monotonic() + args.prompt_timeout):
+            result["error"] = "no prompt from bootrom"
+            return result
+        result["sync"] = time.monotonic() - start
+
+        # Targets with the same capabilities share one encoding of the image.
+        commands = set()
+        if args.compression != "off":
+            commands = await link.remote_commands() & {"fill", "writez"}
+        key = frozenset(commands)
+        if key not in encoded:
+            encoded[key] = asyncio.get_running_loop().run_in_executor(
+                None, encode, key)
+        ops = await encoded[key]
+
+        upload_start = time.monotonic()
+        if not await link.upload(ops):
+            result["error"] = "upload failed"
+            return result
+        result["upload"] = time.monotonic() - upload_start
+        result["wire_bytes"] = link.stats["wire"]
+        if args.boot:
+            await link.boot(entry)
+        result["ok"] = True
+    except (OSError, ConnectionError) as e:
+        result["error"] = str(e)
+    finally:
+        link.close()
+        result["total"] = time.monotonic() - start
+    return result
+
+
+def parse_targets(targets):
+    result = []
+    for target in targets.split(","):
+        host, _, port = target.strip().rpartition(":")
+        result.append((host or "localhost", int(port)))
+    return result
+
+
+async def boot_fleet(targets, entry, segments, args):
+    chunks = [
+        chunk for address, data in segments
+        for chunk in split_chunks(data, address, BootromShell.chunk_size)
+    ]
+
+    def encode(commands):
+        return list(
+            encode_ops(chunks, commands, BootromShell.page_size,
+                       BootromShell.compression_level, {"payload": 0}))
+
+    encoded = {}
+    return await asyncio.gather(*[
+        boot_target(host, port, entry, encoded, encode, args)
+        for host, port in targets
+    ])
+
+
+def run_fleet(args):
+    try:
+        entry, segments = read_elf_segments(args.elf)
+    except (OSError, ELFError) as e:
+        print(f"Could not open '{args.elf}' as an ELF file: {e}")
+        return 1
+    size = sum(len(data) for _, data in segments)
+    print(f"Booting {args.elf} ({size} bytes, entry {hex(entry)}) on "
+          f"{len(args.targets)} targets")
+
+    results = asyncio.run(boot_fleet(args.targets, entry, segments, args))
+
+    print(f"{'target':<24} {'connect':>8} {'sync':>8} {'upload':>8} "
+          f"{'total':>8}  result")
+    for result in results:
+        times = [
+            f"{result[k]:8.2f}" if k in result else f"{'-':>8}"
+            for k in ("connect", "sync", "upload", "total")
+        ]
+        status = "ok" if result["ok"] else result.get("error", "failed")
+        print(f"{result['target']:<24} {' '.join(times)}  {status}")
+    return 0 if all(result["ok"] for result in results) else 1
+
+
+################################################################################
+# Batch mode: run a script of bootshell commands and report timing as JSON
+
+# Commands that only queue uploads in batch mode. Consecutive ones are sent to
+# the bootrom as a single pipelined stream.
+BATCH_UPLOAD_COMMANDS = ("load_elf", "load_file_at", "load_xflash")
+
+
+def run_batch(shell, script, keep_going=False):
+    results = []
+    start = time.monotonic()
+    ok = shell.connected
+    if not ok:
+        results.append({"command": "connect", "status": "failed"})
+    shell.deferred_uploads = []
+
+    def flush():
+        queued = len(shell.deferred_uploads)
+        if not queued:
+            return True
+        shell.error = None
+        flush_start = time.monotonic()
+        flushed = shell.flush_uploads()
+        results.append({
+            "command": f"<upload {queued} queued>",
+            "status": "ok" if flushed else "failed",
+            "seconds": time.monotonic() - flush_start,
+            "payload_bytes": shell.upload_stats["payload"],
+            "wire_bytes": shell.upload_stats["wire"],
+        })
+        return flushed
+
+    stopped = False
+    for line in script:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if stopped or not (ok or keep_going):
+            results.append({"command": line, "status": "skipped"})
+            ok = False
+            continue
+
+        name = line.split()[0]
+        if name not in BATCH_UPLOAD_COMMANDS:
+            ok = flush() and ok
+            # Don't boot or poke a half-written image
+            if not (ok or keep_going):
+                results.append({"command": line, "status": "skipped"})
+                continue
+        shell.error = None
+        command_start = time.monotonic()
+        # Only an explicit exit ends the script. boot_elf also returns True,
+        # to leave the interactive loop, but is usually followed by expects.
+        stopped = shell.onecmd(line) and name == "exit"
+        result = {
+            "command": line,
+            "status": "queued" if name in BATCH_UPLOAD_COMMANDS else "ok",
+            "seconds": time.monotonic() - command_start,
+        }
+        if shell.error is not None:
+            result["status"] = "failed"
+            result["error"] = shell.error
+            ok = False
+        results.append(result)
+    ok = flush() and ok
+    shell.deferred_uploads = None
+
+    return {
+        "ok": ok,
+        "seconds": time.monotonic() - start,
+        "payload_bytes": shell.total_stats["payload"],
+        "wire_bytes": shell.total_stats["wire"],
+        "commands": results,
+    }
+
+
+################################################################################
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bootrom shell")
+    parser.add_argument(
+        "--host",
+        type=lambda target: parse_targets(target)[0],
+        default=BootromShell.default_host_addr,
+        help="host:port of the bootrom (default: localhost:31415)")
+    parser.add_argument(
+        "--pty",
+        nargs="?",
+        const=BootromShell.pty_path,
+        help="talk to the bootrom over a pty or serial device instead "
+        f"(default: {BootromShell.pty_path}, globs allowed)")
+    parser.add_argument("--baud",
+                        type=int,
+                        help="baud rate to configure with --pty")
+    parser.add_argument(
+        "--targets",
+        type=parse_targets,
+        help="comma separated host:port list; boots --elf on all of them "
+        "concurrently instead of starting the interactive shell")
+    parser.add_argument("--elf", help="ELF file to boot with --targets")
+    parser.add_argument("--window",
+                        type=int,
+                        default=BootromShell.default_window,
+                        help="write commands in flight per target")
+    parser.add_argument("--compression",
+                        choices=["auto", "off"],
+                        default=BootromShell.compression,
+                        help="transfer encoding with --targets")
+    parser.add_argument("--connect-timeout",
+                        type=float,
+                        default=BootromShell.connect_timeout,
+                        help="seconds to keep trying to connect")
+    parser.add_argument("--prompt-timeout",
+                        type=float,
+                        default=BootromShell.prompt_timeout,
+                        help="seconds to wait for the bootrom prompt")
+    parser.add_argument("--no-boot",
+                        dest="boot",
+                        action="store_false",
+                        help="upload without booting")
+    parser.add_argument(
+        "--batch",
+        type=argparse.FileType("r"),
+        help="run the bootshell commands in this file ('-' for stdin) and "
+        "print a JSON report instead of starting the interactive shell")
+    parser.add_argument("--report", help="write the batch report to this file")
+    parser.add_argument("--keep-going",
+                        action="store_true",
+                        help="keep running batch commands after a failure")
+    parser.add_argument("--stats",
+                        help="write link statistics as JSON here on exit")
+    parser.add_argument(
+        "--trace", help="write a Chrome trace of the session here on exit")
+    args = parser.parse_args()
+
+    if args.targets:
+        if not args.elf:
+            parser.error("--targets requires --elf")
+        sys.exit(run_fleet(args))
 
-if __name__ == '__main__':
     print("<<shell starting>>")
     shell = BootromShell()
+    shell.default_host_addr = args.host
+    if args.pty:
+        shell.use_pty = True
+        shell.pty_path = args.pty
+        shell.baud_rate = args.baud
+    shell.window = args.window
+    shell.connect_timeout = args.connect_timeout
+    shell.prompt_timeout = args.prompt_timeout
     shell.do_connect()
-    shell.cmdloop()
-    print("<<shell closed>>")
+    status = 0
+    try:
+        if args.batch:
+            report = run_batch(shell, args.batch, args.keep_going)
+            shell.disconnect()
+            report["stats"] = shell.stats.summary()
+            if args.report:
+                with open(args.report, "w", encoding="utf-8") as f:
+                    json.dump(report, f, indent=2)
+            else:
+                print(json.dumps(report, indent=2))
+            status = 0 if report["ok"] else 1
+        else:
+            shell.cmdloop()
+            print("<<shell closed>>")
+    finally:
+        if args.stats:
+            shell.stats.write_summary(args.stats)
+        if args.trace:
+            shell.stats.write_trace(args.trace)
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+#
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Upload throughput benchmark for bootshell against a fake bootrom.
+
+The fake bootrom speaks the same line protocol as the real one (every command
+is answered with a response terminated by ETX) and delays each response by a
+configurable latency to model the simulated UART round-trip.
+"""
+
+import argparse
+import base64
+import contextlib
+import curses.ascii
+import heapq
+import io
+import os
+import random
+import socket
+import tempfile
+import threading
+import time
+import zlib
+
+from bootshell import BootromShell
+
+ETX = bytes([curses.ascii.ETX])
+
+
+class FakeBootrom(threading.Thread):
+    """Single-client bootrom stand-in listening on an ephemeral port."""
+
+    commands = ["write", "writez", "fill", "hash", "boot"]
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0, commands=None):
+        super().__init__(daemon=True)
+        if commands is not None:
+            self.commands = commands
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.writes = []
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(("localhost", 0))
+        self.server.listen(1)
+        self.conn = None
+        self.replies = []
+        self.reply_ready = threading.Condition()
+        self.closed = False
+
+    @property
+    def address(self):
+        return self.server.getsockname()
+
+    def reply(self, text):
+        with self.reply_ready:
+            due = time.monotonic() + self.latency
+            heapq.heappush(self.replies, (due, len(self.replies), text + ETX))
+            self.reply_ready.notify()
+
+    # Replies are sent from their own thread so that the latency models the
+    # link rather than serializing command processing.
+    def send_replies(self):
+        while True:
+            with self.reply_ready:
+                while not self.replies and not self.closed:
+                    self.reply_ready.wait()
+                if self.closed:
+                    return
+                due, _, data = self.replies[0]
+                delay = due - time.monotonic()
+                if delay > 0:
+                    self.reply_ready.wait(delay)
+                    continue
+                heapq.heappop(self.replies)
+            self.conn.sendall(data)
+
+    # Handles one line from the client. {pending} is the (command, address) of
+    # a write waiting for its payload line.
+    def handle(self, line, pending):
+        if pending is not None:
+            command, address = pending
+            if self.random.random() < self.error_rate:
+                self.reply(b"error: corrupt payload")
+                return None
+            data = base64.b64decode(line)
+            if command == b"writez":
+                data = zlib.decompress(data)
+            self.writes.append((address, data))
+            self.reply(b"")
+            return None
+        words = line.split()
+        if words and words[0].decode() not in self.commands + ["help", "echo"]:
+            self.reply(b"error: unknown command")
+            return None
+        if line.startswith((b"write ", b"writez ")):
+            self.reply(b"")
+            return words[0], int(words[1], 16)
+        if line.startswith(b"fill "):
+            address, size, value = [int(x, 16) for x in words[1:4]]
+            self.writes.append((address, bytes([value]) * size))
+            self.reply(b"")
+            return None
+        if line == b"help":
+            self.reply("\n".join(self.commands).encode() + b"\n")
+            return None
+        if line.startswith(b"hash "):
+            address, size = [int(x, 16) for x in line.split()[1:3]]
+            crc = zlib.crc32(self.contents(address, size))
+            self.reply(f"0x{crc:08x}".encode())
+            return None
+        if not line:
+            self.reply(b"BOOTROM> ")
+        else:
+            self.reply(b"")
+        return None
+
+    def run(self):
+        self.conn, _ = self.server.accept()
+        self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        threading.Thread(target=self.send_replies, daemon=True).start()
+        pending = None
+        with self.conn.makefile("rb") as reader:
+            for line in reader:
+                pending = self.handle(line.strip(), pending)
+        self.close()
+
+    def close(self):
+        with self.reply_ready:
+            self.closed = True
+            self.reply_ready.notify()
+        self.server.close()
+
+    def contents(self, address, size):
+        result = bytearray(size)
+        for addr, data in self.writes:
+            offset = addr - address
+            if -len(data) < offset < size:
+                piece = data[max(0, -offset):size - offset]
+                result[max(0, offset):max(0, offset) + len(piece)] = piece
+        return bytes(result)
+
+
+def run_upload(blob, window, latency, error_rate, compression):
+    bootrom = FakeBootrom(latency=latency, error_rate=error_rate)
+    bootrom.start()
+    shell = BootromShell()
+    shell.default_host_addr = bootrom.address
+    shell.window = window
+    shell.compression = compression
+    with contextlib.redirect_stdout(io.StringIO()):
+        shell.do_connect()
+        start = time.monotonic()
+        ok = shell.load_blob_at(blob, 0x10000000)
+        elapsed = time.monotonic() - start
+        shell.do_exit()
+    ok = ok and bootrom.contents(0x10000000, len(blob)) == blob
+    return ok, elapsed, shell.upload_stats["wire"]
+
+
+# Uploads {blob} through the page cache, changes {dirty_pages} pages and
+# uploads it again as a new session would after a warm reboot.
+def run_warm_upload(blob, dirty_pages, latency, cache_path):
+    bootrom = FakeBootrom(latency=latency)
+    bootrom.start()
+    shell = BootromShell()
+    shell.default_host_addr = bootrom.address
+    shell.page_cache_path = cache_path
+    with contextlib.redirect_stdout(io.StringIO()):
+        shell.do_connect()
+        cold_start = time.monotonic()
+        ok = shell.load_segment(blob, 0x10000000)
+        cold = time.monotonic() - cold_start
+        blob = bytearray(blob)
+        for page in random.Random(1).sample(
+                range(len(blob) // shell.page_size), dirty_pages):
+            blob[page * shell.page_size] ^= 0xff
+        blob = bytes(blob)
+        shell.reset_session()
+        warm_start = time.monotonic()
+        ok = ok and shell.load_segment(blob, 0x10000000)
+        warm = time.monotonic() - warm_start
+        shell.do_exit()
+    ok = ok and bootrom.contents(0x10000000, len(blob)) == blob
+    return ok, cold, warm
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare bootshell upload modes against a fake bootrom.")
+    parser.add_argument("--size", type=int, default=4,
+                        help="payload size in MiB (default: 4)")
+    parser.add_argument("--latency-ms", type=float, default=2.0,
+                        help="simulated response latency (default: 2)")
+    parser.add_argument("--windows", default="1,2,4,8,16",
+                        help="comma separated upload windows to compare")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="fraction of payloads the bootrom rejects")
+    parser.add_argument("--zero-fraction", type=float, default=0.0,
+                        help="fraction of the payload that is zero filled")
+    parser.add_argument("--compression", choices=["auto", "off"],
+                        default="auto", help="bootshell transfer encoding")
+    parser.add_argument("--dirty-pages", type=int, default=0,
+                        help="also time a differential re-upload with this "
+                        "many changed pages")
+    args = parser.parse_args()
+
+    size = args.size * 1024 * 1024
+    zeros = int(size * args.zero_fraction)
+    blob = os.urandom(size - zeros) + bytes(zeros)
+    print(f"{'window':>8} {'seconds':>10} {'KiB/s':>10} {'wire KiB':>10} "
+          f"{'result':>8}")
+    for window in [int(w) for w in args.windows.split(",")]:
+        ok, elapsed, wire = run_upload(blob, window, args.latency_ms / 1000.0,
+                                       args.error_rate, args.compression)
+        rate = len(blob) / elapsed / 1024
+        print(f"{window:>8} {elapsed:>10.3f} {rate:>10.1f} "
+              f"{wire / 1024:>10.1f} {'ok' if ok else 'CORRUPT':>8}")
+
+    if args.dirty_pages:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            ok, cold, warm = run_warm_upload(
+                blob, args.dirty_pages, args.latency_ms / 1000.0,
+                os.path.join(tmp_dir, "page_cache.json"))
+        print(f"differential: cold {cold:.3f}s, warm {warm:.3f}s with "
+              f"{args.dirty_pages} dirty pages {'ok' if ok else 'CORRUPT'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -16,49 +16,44 @@
 
 """Download IREE host compiler from the snapshot release."""
 
-import errno
 import os
 import sys
 import shutil
 import subprocess
-import tarfile
-import time
 import argparse
-import urllib
 from pathlib import Path
 import requests
-import wget
 
+import download_util
 
-def download_artifact(assets, keywords, out_dir):
-    """Download the artifact from the asset list based on the keyword."""
-    # Find the linux tarball and download it.
-    artifact_match = False
+from artifact_cache import ArtifactCache
+
+
+def find_asset(assets, keywords):
+    """Find the asset whose name contains all the keywords."""
     for asset in assets:
-        download_url = asset["browser_download_url"]
-        artifact_name = asset["name"]
-        if all(x in artifact_name for x in keywords):
-            artifact_match = True
-            break
-    if not artifact_match:
-        print(f"{keywords[0]} is not found")
-        sys.exit(1)
+        if all(x in asset["name"] for x in keywords):
+            return asset
+    print(f"{keywords[0]} is not found")
+    sys.exit(1)
+
 
+def asset_checksum(asset, manifest):
+    """A pinned checksum wins over the one published with the release."""
+    return (manifest or {}).get(asset["name"]) or download_util.asset_sha256(
+        asset)
+
+
+def download_artifact(assets, keywords, out_dir, manifest=None):
+    """Download the artifact from the asset list based on the keyword."""
+    asset = find_asset(assets, keywords)
+    download_url = asset["browser_download_url"]
+    artifact_name = asset["name"]
     print(f"\nDownload {artifact_name} from {download_url}\n")
-    if not os.path.isdir(out_dir):
-        os.makedirs(out_dir)
     out_file = os.path.join(out_dir, artifact_name)
-
-    num_retries = 3
-    for i in range(num_retries + 1):
-        try:
-            wget.download(download_url, out=out_file)
-            break
-        except (urllib.error.HTTPError, ConnectionError) as e:
-            if i == num_retries:
-                raise
-            print(f"{e}\nDownload failed. Retrying...")
-            time.sleep(5)
+    download_util.download(download_url, out_file,
+                           sha256=asset_checksum(asset, manifest),
+                           connections=4)
     return out_file
 
 
@@ -93,6 +88,16 @@ def main():
         default="",
         help=("IREE compiler installed directory")
     )
+    parser.add_argument(
+        "--sha256_manifest", action="store", default="",
+        help="JSON file mapping artifact names to their pinned SHA-256")
+    parser.add_argument(
+        "--cache_dir", action="store", default="",
+        help="artifact cache shared between workspaces "
+        "(default: $SPARROW_ARTIFACT_CACHE or ~/.cache/sparrow-artifacts)")
+    parser.add_argument(
+        "--no_cache", action="store_true",
+        help="download straight into --iree_compiler_dir, bypassing the cache")
     args = parser.parse_args()
 
     # Check if the IREE runtime lib is in sync with the tag
@@ -155,38 +160,57 @@ def main():
         print("IREE compiler is up-to-date")
         sys.exit(0)
 
-    tmp_dir = Path(os.getenv("OUT")) / "tmp"
-    whl_file = download_artifact(snapshot["assets"],
-                                 ["iree_tools_tflite", ".whl"], tmp_dir)
-    tar_file = download_artifact(
-        snapshot["assets"], ["linux-x86_64.tar"], tmp_dir)
+    manifest = None
+    if args.sha256_manifest:
+        manifest = download_util.load_manifest(args.sha256_manifest)
+    cache = None if args.no_cache else ArtifactCache(args.cache_dir)
+    assets = snapshot["assets"]
 
     # Install IREE TFLite tool
-    cmd = (f"pip3 install --target={iree_compiler_dir} {whl_file} "
-           "--upgrade --no-cache-dir")
-    os.system(cmd)
+    def install_whl(whl_file):
+        cmd = (f"pip3 install --target={iree_compiler_dir} {whl_file} "
+               "--upgrade --no-cache-dir")
+        os.system(cmd)
+
+    whl_keywords = ["iree_tools_tflite", ".whl"]
+    if cache:
+        whl_asset = find_asset(assets, whl_keywords)
+        with cache.entry(f"{tag_name}/{whl_asset['name']}",
+                         lambda tree: download_artifact(
+                             assets, whl_keywords, tree, manifest)) as tree:
+            install_whl(os.path.join(tree, whl_asset["name"]))
+    else:
+        tmp_dir = Path(os.getenv("OUT")) / "tmp"
+        whl_file = download_artifact(assets, whl_keywords, tmp_dir, manifest)
+        install_whl(whl_file)
+        os.remove(whl_file)
 
-    # Extract the tarball to ${iree_compiler_dir}/install
+    # Extract the tarball to ${iree_compiler_dir}/install while it downloads
     install_dir = iree_compiler_dir / "install"
-    if not install_dir:
-        os.makedirs(install_dir)
+    tar_asset = find_asset(assets, ["linux-x86_64.tar"])
 
-    with tarfile.open(tar_file) as tar:
-        tar.extractall(path=install_dir)
+    def fetch(out_dir):
+        print(f"\nDownload {tar_asset['name']} from "
+              f"{tar_asset['browser_download_url']}\n")
+        download_util.download_and_extract(
+            tar_asset["browser_download_url"], out_dir,
+            asset_checksum(tar_asset, manifest))
 
+    if cache:
+        cache.install(f"{tag_name}/{tar_asset['name']}", install_dir, fetch)
+    else:
+        fetch(install_dir)
+
+    # Replace rather than overwrite, the file may be linked into the cache
+    tflite_tool = f"{install_dir}/bin/iree-import-tflite"
     try:
+        if os.path.lexists(tflite_tool):
+            os.remove(tflite_tool)
         shutil.copy2(f"{iree_compiler_dir}/bin/iree-import-tflite",
-                     f"{install_dir}/bin/iree-import-tflite",
-                     follow_symlinks=True)
+                     tflite_tool, follow_symlinks=True)
     except OSError as e:
-        if e.errno == errno.EEXIST:
-            os.remove(f"{install_dir}/bin/iree-import-tflite")
-            shutil.copy2(f"{iree_compiler_dir}/bin/iree-import-tflite",
-                         f"{install_dir}/bin/iree-import-tflite",
-                         follow_symlinks=True)
-
-    os.remove(tar_file)
-    os.remove(whl_file)
+        print(f"Failed to install iree-import-tflite: {e}")
+
     print("\nIREE compiler is installed")
 
     # Add tag file for future checks
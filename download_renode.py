@@ -20,48 +20,25 @@ import argparse
 import os
 import re
 import sys
-import time
-import tarfile
-import urllib
+import urllib.request
 
 from pathlib import Path
 
-import wget
+import download_util
 
+from artifact_cache import ArtifactCache
 
-def download_artifact(url, artifact_name, out_dir):
+
+def download_artifact(url, artifact_name, out_dir, sha256=None,
+                      connections=4):
     """Download the artifact from url."""
-    if not os.path.isdir(out_dir):
-        os.makedirs(out_dir)
     out_file = os.path.join(out_dir, artifact_name)
     download_url = os.path.join(url, artifact_name)
-    num_retries = 3
-    for i in range(num_retries + 1):
-        try:
-            wget.download(download_url, out=out_file)
-            break
-        except urllib.error.HTTPError as exception:
-            if i == num_retries:
-                raise
-            print(f"{exception}\nDownload failed. Retrying...")
-            time.sleep(5)
+    download_util.download(download_url, out_file, sha256=sha256,
+                           connections=connections)
     return out_file
 
 
-def strip_top_directory(tar):
-    """Renode packages the release with a top directory. Need to strip it."""
-    members = tar.getmembers()
-    out_members = []
-    for member in members[1:]:
-        if member.path.startswith(members[0].name + "/"):
-            member.path = os.path.join(
-                *(member.name.split(os.path.sep)[1:]))
-            out_members.append(member)
-
-    tag = re.search("(.+?)_portable", members[0].name).group(1)
-    return tag, out_members
-
-
 def main():
     """Download and install renode release package."""
     pin_toolchains = os.getenv('PIN_TOOLCHAINS', '').lower().split(' ')
@@ -97,6 +74,23 @@ def main():
         default="",
         help=("Renode installed directory")
     )
+    parser.add_argument(
+        "--sha256_manifest", action="store", default="",
+        help="JSON file mapping artifact names to their pinned SHA-256")
+    parser.add_argument(
+        "--connections", action="store", type=int, default=4,
+        help="parallel connections used by --no_stream (default: 4)")
+    parser.add_argument(
+        "--no_stream", action="store_true",
+        help="download the tarball to $OUT/tmp before extracting it, "
+        "instead of extracting it as it downloads")
+    parser.add_argument(
+        "--cache_dir", action="store", default="",
+        help="artifact cache shared between workspaces "
+        "(default: $SPARROW_ARTIFACT_CACHE or ~/.cache/sparrow-artifacts)")
+    parser.add_argument(
+        "--no_cache", action="store_true",
+        help="download straight into --renode_dir, bypassing the cache")
 
     args = parser.parse_args()
 
@@ -153,16 +147,30 @@ def main():
         print("Renode is up-to-date")
         sys.exit(0)
 
-    tmp_dir = Path(out_dir) / "tmp"
     artifact_name = release_name + ".linux-portable.tar.gz"
-    tar_file = download_artifact(args.release_url, artifact_name, tmp_dir)
-
-    # Extract the tarball
-    with tarfile.open(tar_file) as tar:
-        _, members = strip_top_directory(tar)
-        tar.extractall(members=members, path=renode_dir)
-
-    os.remove(tar_file)
+    sha256 = None
+    if args.sha256_manifest:
+        sha256 = download_util.load_manifest(
+            args.sha256_manifest).get(artifact_name)
+
+    # Renode packages the release with a top directory, which is stripped.
+    def fetch(install_dir):
+        if args.no_stream:
+            tmp_dir = Path(out_dir) / "tmp"
+            tar_file = download_artifact(args.release_url, artifact_name,
+                                         tmp_dir, sha256, args.connections)
+            download_util.extract(tar_file, install_dir, strip_components=1)
+            os.remove(tar_file)
+        else:
+            download_util.download_and_extract(
+                os.path.join(args.release_url, artifact_name), install_dir,
+                sha256, strip_components=1)
+
+    if args.no_cache:
+        fetch(renode_dir)
+    else:
+        # The release name carries the commit the package was built from
+        ArtifactCache(args.cache_dir).install(release_name, renode_dir, fetch)
     print("\nRenode is installed")
 
     # Add tag file for future checks
@@ -0,0 +1,523 @@
+#!/usr/bin/env python3
+#
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Resumable, checksum-verified downloads for the toolchain fetchers.
+
+Downloads go to <file>.part and are resumed from there with HTTP Range
+requests after a failure, with exponential backoff between attempts. Large
+files from servers that accept ranges can be fetched over several
+connections; <file>.part.segments then records how far each connection
+got, so that those resume too. The SHA-256 of the file is computed while it
+downloads and checked before the file is renamed into place.
+
+Tarballs that are only needed unpacked can instead be extracted while they
+download, without the archive ever touching the disk.
+"""
+
+import hashlib
+import http.client
+import json
+import lzma
+import os
+import random
+import shutil
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import zlib
+
+CHUNK_SIZE = 1 << 20
+
+# Errors worth retrying: connection problems and server side failures
+RETRY_HTTP_CODES = (408, 429, 500, 502, 503, 504)
+
+
+class DownloadError(Exception):
+    pass
+
+
+def backoff_delay(attempt, base=1.0, limit=60.0):
+    """Exponential backoff with jitter for retry {attempt} (0 based)."""
+    return min(limit, base * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+def load_manifest(path):
+    """Reads a pinned {"artifact name": "sha256 hex"} manifest."""
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def asset_sha256(asset):
+    """The SHA-256 GitHub publishes for a release asset, if any."""
+    digest = asset.get("digest") or ""
+    if digest.startswith("sha256:"):
+        return digest[len("sha256:"):]
+    return None
+
+
+class Progress:
+    """Prints a progress line at most once a second."""
+
+    def __init__(self, name, total):
+        self.name = name
+        self.total = total
+        self.done = 0
+        self.printed = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, count):
+        with self.lock:
+            self.done += count
+            now = time.monotonic()
+            if now - self.printed < 1.0:
+                return
+            self.printed = now
+        self.show()
+
+    def show(self, end=""):
+        if self.total:
+            sys.stdout.write("\r%s: %3d%% (%d/%d MiB)%s" % (
+                self.name, 100 * self.done // self.total, self.done >> 20,
+                self.total >> 20, end))
+        else:
+            sys.stdout.write("\r%s: %d MiB%s" % (self.name, self.done >> 20,
+                                                 end))
+        sys.stdout.flush()
+
+
+def open_url(url, start=0, end=None, timeout=60):
+    """Opens {url}, asking for bytes {start} to {end} inclusive if either is
+    set. Returns the response and the offset its body starts at."""
+    request = urllib.request.Request(url)
+    if start or end is not None:
+        request.add_header("Range", "bytes=%d-%s" % (
+            start, "" if end is None else end))
+    response = urllib.request.urlopen(request, timeout=timeout)
+    if response.status == 206:
+        return response, start
+    # The server ignored the range and sends the whole file
+    return response, 0
+
+
+def probe(url, timeout=60):
+    """Returns (size, accepts ranges) of {url}; size is None if unknown."""
+    try:
+        with open_url(url, 0, 0, timeout)[0] as response:
+            if response.status == 206:
+                content_range = response.headers.get("Content-Range", "")
+                total = content_range.rpartition("/")[2]
+                return (int(total) if total.isdigit() else None), True
+            length = response.headers.get("Content-Length")
+            return (int(length) if length else None), False
+    except urllib.error.HTTPError as e:
+        # Some servers answer an unsatisfiable range for empty files
+        if e.code == 416:
+            return 0, True
+        raise
+
+
+def retrying(what, retries, function):
+    """Calls {function}(attempt) until it returns without a retryable error,
+    sleeping with exponential backoff in between."""
+    for attempt in range(retries + 1):
+        try:
+            return function(attempt)
+        except urllib.error.HTTPError as e:
+            if e.code not in RETRY_HTTP_CODES or attempt == retries:
+                raise
+            error = e
+        except (urllib.error.URLError, http.client.IncompleteRead,
+                ConnectionError, TimeoutError) as e:
+            if attempt == retries:
+                raise
+            error = e
+        delay = backoff_delay(attempt)
+        print(f"\n{what}: {error}. Retrying in {delay:.1f}s...")
+        time.sleep(delay)
+    raise AssertionError("unreachable")
+
+
+class SequentialHasher:
+    """Hashes a file that is written in segments, in file order, as soon as
+    each byte is written. Segments other than the one being hashed are read
+    back from the page cache when the hasher reaches them. {written} gives
+    the end of what is already written of each segment when resuming."""
+
+    def __init__(self, fd, segments, written=None):
+        self.fd = fd
+        self.digest = hashlib.sha256()
+        # (start, end) of each segment and how much of it is written
+        self.segments = segments
+        self.written = list(written or [start for start, _ in segments])
+        self.position = 0
+        self.current = 0
+        self.lock = threading.Lock()
+        self.advance()
+
+    def wrote(self, segment, end):
+        with self.lock:
+            self.written[segment] = end
+            self.advance()
+
+    # Hashes what is written contiguously past the hashed prefix, with
+    # {lock} held.
+    def advance(self):
+        while self.current < len(self.segments):
+            frontier = self.written[self.current]
+            while self.position < frontier:
+                data = os.pread(self.fd, min(CHUNK_SIZE,
+                                             frontier - self.position),
+                                self.position)
+                if not data:
+                    raise DownloadError("short read while hashing")
+                self.digest.update(data)
+                self.position += len(data)
+            if frontier < self.segments[self.current][1]:
+                break
+            self.current += 1
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+
+class SegmentState:
+    """How far each segment of a segmented download got, kept in
+    {part_file}.segments so that a later run resumes every segment where
+    it stopped. It is saved at most once a second while downloading."""
+
+    def __init__(self, part_file, size, segments, written):
+        self.path = part_file + ".segments"
+        self.size = size
+        self.segments = segments
+        self.written = list(written)
+        self.saved = 0.0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, part_file, size):
+        """The state saved for {part_file} if it holds a download of {size}
+        bytes, else None."""
+        try:
+            with open(part_file + ".segments", "r", encoding="utf-8") as f:
+                saved = json.load(f)
+            segments = [(start, end) for start, end in saved["segments"]]
+            written = saved["written"]
+            if (saved["size"] != size or os.path.getsize(part_file) != size
+                    or len(written) != len(segments)
+                    or not all(start <= position <= end for (start, end),
+                               position in zip(segments, written))):
+                return None
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        return cls(part_file, size, segments, written)
+
+    def wrote(self, segment, end):
+        with self.lock:
+            self.written[segment] = end
+            if time.monotonic() - self.saved >= 1.0:
+                self.save_locked()
+
+    def save(self):
+        with self.lock:
+            self.save_locked()
+
+    def save_locked(self):
+        tmp = "%s.%d" % (self.path, os.getpid())
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"size": self.size, "segments": self.segments,
+                       "written": self.written}, f)
+        os.replace(tmp, self.path)
+        self.saved = time.monotonic()
+
+    @staticmethod
+    def discard(part_file):
+        """Removes {part_file} and its segment state, if any."""
+        for path in (part_file, part_file + ".segments"):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def download_segment(url, fd, index, start, end, hasher, state, progress,
+                     retries):
+    """Downloads bytes [{start}, {end}) into {fd}, resuming from the last
+    byte written after a failure."""
+    position = start
+
+    def attempt(_):
+        nonlocal position
+        response, offset = open_url(url, position, end - 1)
+        with response:
+            if offset != position:
+                raise DownloadError("server stopped honouring ranges")
+            while position < end:
+                data = response.read(min(CHUNK_SIZE, end - position))
+                if not data:
+                    raise ConnectionError("connection closed early")
+                os.pwrite(fd, data, position)
+                position += len(data)
+                hasher.wrote(index, position)
+                state.wrote(index, position)
+                progress.add(len(data))
+
+    if position < end:
+        retrying("segment %d" % index, retries, attempt)
+
+
+def download_segmented(url, part_file, size, connections, progress, retries):
+    """Downloads {size} bytes over {connections} parallel range requests,
+    resuming the segments of an earlier run from its SegmentState. On
+    failure the part file and its state are kept for the next run.
+    Returns the SHA-256 hex digest."""
+    state = SegmentState.load(part_file, size)
+    if state:
+        fd = os.open(part_file, os.O_RDWR)
+        progress.add(sum(position - start for (start, _), position in
+                         zip(state.segments, state.written)))
+    else:
+        step = -(-size // connections)
+        segments = [(start, min(start + step, size))
+                    for start in range(0, size, step)]
+        state = SegmentState(part_file, size, segments,
+                             [start for start, _ in segments])
+        fd = os.open(part_file, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.ftruncate(fd, size)
+        # Without the state, a later run would take the preallocated part
+        # file for a complete one
+        state.save()
+        hasher = SequentialHasher(fd, state.segments, state.written)
+        errors = []
+
+        def run(index):
+            try:
+                download_segment(url, fd, index, state.written[index],
+                                 state.segments[index][1], hasher, state,
+                                 progress, retries)
+            except Exception as e:  # pylint: disable=broad-except
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(index,))
+                   for index in range(len(state.segments))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        os.remove(state.path)
+        return hasher.hexdigest()
+    except BaseException:
+        state.save()
+        raise
+    finally:
+        os.close(fd)
+
+
+def download_stream(url, part_file, progress, retries):
+    """Downloads over one connection, appending to {part_file} and resuming
+    where it stopped. Returns the SHA-256 hex digest."""
+    digest = hashlib.sha256()
+    # Hash what an earlier run already fetched before appending to it
+    if os.path.exists(part_file):
+        with open(part_file, "rb") as f:
+            while data := f.read(CHUNK_SIZE):
+                digest.update(data)
+        progress.add(os.path.getsize(part_file))
+
+    def attempt(_):
+        nonlocal digest
+        position = os.path.getsize(part_file) if os.path.exists(
+            part_file) else 0
+        try:
+            response, offset = open_url(url, position)
+        except urllib.error.HTTPError as e:
+            # Asking for bytes past the end: the part file is complete
+            if e.code == 416 and position:
+                return
+            raise
+        with response, open(part_file, "r+b" if offset else "wb") as out:
+            if offset != position:
+                # No resume possible, start over
+                digest = hashlib.sha256()
+                progress.done = 0
+            out.seek(offset)
+            while data := response.read(CHUNK_SIZE):
+                out.write(data)
+                digest.update(data)
+                progress.add(len(data))
+            out.truncate()
+            # An early close can look like a normal end of the body
+            if response.length:
+                raise ConnectionError("connection closed early")
+
+    retrying(os.path.basename(part_file), retries, attempt)
+    return digest.hexdigest()
+
+
+def download(url, out_file, sha256=None, connections=1,
+             min_segment_size=32 << 20, retries=5):
+    """Downloads {url} to {out_file} and returns its SHA-256 hex digest.
+
+    An interrupted download is resumed from {out_file}.part, both across
+    retries and across runs. With {connections} > 1 and a server that accepts
+    ranges, files of at least {min_segment_size} per connection are fetched
+    in parallel segments. If {sha256} is set and does not match, the partial
+    file is removed and DownloadError raised.
+    """
+    out_dir = os.path.dirname(out_file)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    part_file = out_file + ".part"
+    name = os.path.basename(out_file)
+
+    size, ranges = retrying(name, retries, lambda _: probe(url))
+    connections = min(connections, (size or 0) // min_segment_size)
+    progress = Progress(name, size)
+    if ranges and size and connections > 1:
+        digest = download_segmented(url, part_file, size, connections,
+                                    progress, retries)
+    else:
+        # A segmented part file is preallocated, so it can't be appended to
+        if os.path.exists(part_file + ".segments"):
+            SegmentState.discard(part_file)
+        digest = download_stream(url, part_file, progress, retries)
+    progress.show("\n")
+
+    if sha256 and digest != sha256.lower():
+        os.remove(part_file)
+        raise DownloadError(f"{name}: SHA-256 {digest} does not match the "
+                            f"expected {sha256}")
+    os.replace(part_file, out_file)
+    return digest
+
+
+class HashingReader:
+    """File-like wrapper that hashes and counts everything read through it,
+    so a stream can be verified as it is consumed."""
+
+    def __init__(self, stream, progress):
+        self.stream = stream
+        self.progress = progress
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.digest.update(data)
+        self.progress.add(len(data))
+        return data
+
+
+def strip_member(member, components):
+    """Drops the first {components} directories from {member}'s path, and
+    from its link target for hard links. Returns False if nothing is left or
+    the path would leave the extraction directory."""
+    if components:
+        parts = member.name.split("/")[components:]
+        if not parts or not "".join(parts):
+            return False
+        member.name = "/".join(parts)
+        if member.islnk():
+            member.linkname = "/".join(
+                member.linkname.split("/")[components:])
+    return not (os.path.isabs(member.name) or
+                ".." in member.name.split("/"))
+
+
+def install_tree(staging_dir, out_dir):
+    """Moves the entries of {staging_dir} into {out_dir}, replacing entries
+    with the same names."""
+    os.makedirs(out_dir, exist_ok=True)
+    for name in os.listdir(staging_dir):
+        target = os.path.join(out_dir, name)
+        if os.path.isdir(target) and not os.path.islink(target):
+            shutil.rmtree(target)
+        elif os.path.lexists(target):
+            os.remove(target)
+        os.replace(os.path.join(staging_dir, name), target)
+
+
+def extract_stream(stream, staging_dir, strip_components):
+    """Extracts a tarball from a non-seekable {stream} in a single pass."""
+    with tarfile.open(fileobj=stream, mode="r|*") as tar:
+        for member in tar:
+            if strip_member(member, strip_components):
+                tar.extract(member, staging_dir)
+
+
+def extract(tar_file, out_dir, strip_components=0):
+    """Extracts a local tarball to {out_dir} in one decompression pass,
+    staged the same way as download_and_extract."""
+    parent = os.path.dirname(os.path.abspath(out_dir))
+    os.makedirs(parent, exist_ok=True)
+    staging_dir = tempfile.mkdtemp(prefix=".extract-", dir=parent)
+    try:
+        with open(tar_file, "rb") as f:
+            extract_stream(f, staging_dir, strip_components)
+        install_tree(staging_dir, out_dir)
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def download_and_extract(url, out_dir, sha256=None, strip_components=0,
+                         retries=5):
+    """Streams the tarball at {url} straight into tarfile and extracts it to
+    {out_dir}, dropping {strip_components} leading directories from each
+    path. Returns the archive's SHA-256 hex digest.
+
+    Members are extracted into a staging directory next to {out_dir} and
+    only moved into place once the whole archive has arrived and matched
+    {sha256}, so a failed or corrupt download leaves {out_dir} untouched.
+    Network and decompression overlap, and a failed attempt restarts from
+    the beginning since a compressed stream cannot be resumed mid-way.
+    """
+    name = url.rpartition("/")[2]
+    parent = os.path.dirname(os.path.abspath(out_dir))
+    os.makedirs(parent, exist_ok=True)
+
+    def attempt(_):
+        staging_dir = tempfile.mkdtemp(prefix=".extract-", dir=parent)
+        try:
+            response, _ = open_url(url)
+            with response:
+                progress = Progress(name, response.length)
+                reader = HashingReader(response, progress)
+                try:
+                    extract_stream(reader, staging_dir, strip_components)
+                    # Hash any padding after the end of archive marker too
+                    while reader.read(CHUNK_SIZE):
+                        pass
+                except (tarfile.TarError, EOFError, zlib.error,
+                        lzma.LZMAError) as e:
+                    # Most likely the stream was cut off or garbled on the
+                    # way, so retry it like any other network error
+                    raise ConnectionError(f"bad archive stream: {e}") from e
+                if response.length:
+                    raise ConnectionError("connection closed early")
+            progress.show("\n")
+            digest = reader.digest.hexdigest()
+            if sha256 and digest != sha256.lower():
+                raise DownloadError(f"{name}: SHA-256 {digest} does not "
+                                    f"match the expected {sha256}")
+            install_tree(staging_dir, out_dir)
+            return digest
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+
+    return retrying(name, retries, attempt)
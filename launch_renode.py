@@ -15,22 +15,23 @@
 # limitations under the License.
 
 import argparse
-import IPython
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
 import logging
 import threading
 import os
+import queue
+import re
 import socket
 import subprocess
 import sys
-import telnetlib
 import time
 
 ENVIRON = os.environ.copy()
 
 log = logging.getLogger()
-log_handle = logging.StreamHandler()
-log.addHandler(log_handle)
-log.setLevel(logging.INFO)
 
 
 parser = argparse.ArgumentParser(
@@ -56,31 +57,135 @@ parser.add_argument('--setup_uart', dest='setup_uart',
 parser.add_argument('-U', '--uart_name', dest='uart_name',
                     help='select uart', default="sysbus.uart")
 
+parser.add_argument('--renode_log', dest='renode_log',
+                    help='write renode output to this file, rotated at 64 MiB',
+                    default="")
 
-class RenodeMonitor(object):
-    def __init__(self, host="127.0.0.1", port=1234):
-        self.host = host
-        self.port = port
-        self.tn = None
+parser.add_argument('--renode_log_rate', dest='renode_log_rate', type=int,
+                    help='most renode output lines a second to show here, '
+                    'the rest are only counted (default: 200)', default=200)
 
+parser.add_argument('--log_peripheral', dest='log_sampling',
+                    metavar='NAME=N', help='keep one in N renode log lines '
+                    'from peripheral NAME, 0 drops them, may be repeated',
+                    default=[], action="append")
 
-    def connect(self):
-        self.tn = telnetlib.Telnet(host=self.host, port=self.port)
-        self.recieve_all()
+parser.add_argument('--uart_log', dest='uart_log',
+                    help='also append the uart output to this file',
+                    default="")
+
+parser.add_argument('--log_uart', dest='log_uarts', metavar='PORT=FILE',
+                    help='log another socket terminal while connected to '
+                    'the uart, may be repeated', default=[],
+                    action="append")
+
+
+# Telnet negotiation and ANSI colour sequences the monitor mixes into its
+# output.
+TELNET_IAC = re.compile(rb"\xff(?:[\xfb-\xfe].|\xfa.*?\xff\xf0|[^\xff])",
+                        re.DOTALL)
+ANSI_ESCAPE = re.compile(rb"\x1b\[[0-9;?]*[A-Za-z]")
+# The monitor starts a line with "(monitor) " or "(<machine name>) " once it is
+# ready for the next command, and echoes that command after it.
+MONITOR_PROMPT = re.compile(rb"^\r?\(([\w.\-]+)\) ", re.MULTILINE)
+
+
+def clean_monitor_output(data):
+    return ANSI_ESCAPE.sub(b"", TELNET_IAC.sub(b"", data))
+
+
+# Removes the text up to and including the first prompt from {buffer}.
+# Returns (text, machine name), or None if no prompt has arrived yet.
+def take_reply(buffer):
+    match = MONITOR_PROMPT.search(buffer)
+    if not match:
+        return None
+    reply = bytes(buffer[:match.start()])
+    machine = match.group(1).decode(errors="replace")
+    del buffer[:match.end()]
+    return reply.decode(errors="replace"), machine
+
+
+# Drops the monitor's echo of {command} from {reply}.
+def strip_echo(command, reply):
+    reply = reply.replace("\r", "")
+    first, _, rest = reply.partition("\n")
+    if first.strip() == command.strip():
+        return rest
+    return reply
 
-    def recieve_all(self):
+
+class RenodeMonitor(object):
+    def __init__(self, host="127.0.0.1", port=1234, timeout=60.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sock = None
+        self.buffer = bytearray()
+        self.machine = None
+
+    # Retries until renode has its monitor listening, which takes a few
+    # seconds after a cold start.
+    def connect(self, timeout=60.0):
+        deadline = time.monotonic() + timeout
+        delay = 0.05
         while True:
-            reply = self.tn.read_until("\n", timeout=.1)
+            try:
+                self.sock = socket.create_connection((self.host, self.port))
+                break
+            except ConnectionRefusedError:
+                if time.monotonic() + delay > deadline:
+                    raise
+                time.sleep(delay)
+                delay = min(2 * delay, 1.0)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer.clear()
+        self.read_reply(deadline)
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    # Reads up to the next prompt and returns everything before it.
+    def read_reply(self, deadline=None):
+        if deadline is None:
+            deadline = time.monotonic() + self.timeout
+        while True:
+            taken = take_reply(self.buffer)
+            if taken:
+                reply, self.machine = taken
+                return reply
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("No renode monitor prompt on port %d" %
+                                   self.port)
+            self.sock.settimeout(remaining)
+            try:
+                data = self.sock.recv(65536)
+            except socket.timeout:
+                continue
+            if not data:
+                raise ConnectionError("Renode monitor closed the connection")
+            self.buffer += clean_monitor_output(data)
+
+    # Sends {commands} in one write and collects one reply per command, so a
+    # batch costs a single round trip plus renode's execution time.
+    def send_commands(self, commands, timeout=None):
+        deadline = time.monotonic() + (timeout or self.timeout)
+        for command in commands:
+            log.info("Send command: %s", command)
+        self.sock.sendall("".join("%s\n" % c for c in commands).encode())
+        replies = []
+        for command in commands:
+            reply = strip_echo(command, self.read_reply(deadline))
             if reply:
                 log.info(reply)
-            else:
-                break
+            replies.append(reply)
+        return replies
 
-    def send_command(self, command):
-        log.info("Send command: %s", command)
-        cmd = "\n%s\n" % command
-        self.tn.write(cmd)
-        self.recieve_all()
+    def send_command(self, command, timeout=None):
+        return self.send_commands([command], timeout)[0]
 
     def start(self):
         self.send_command("start")
@@ -90,46 +195,364 @@ class RenodeMonitor(object):
 
     def setup_uart(self, uart_name="sysbus.uart"):
         log.info("Setup the uart %s", uart_name)
-        self.send_command('emulation CreateServerSocketTerminal 3456 "term"')
-        self.send_command("connector Connect %s term" % uart_name)
-        time.sleep(0.5)
-        self.recieve_all()
+        self.send_commands([
+            'emulation CreateServerSocketTerminal 3456 "term"',
+            "connector Connect %s term" % uart_name])
 
+    # Drops every machine and external (UART terminals included) so the
+    # process can run another script.
+    def clear(self):
+        self.send_command("Clear")
+
+    # Renode exits without printing another prompt.
     def quit(self):
-        self.send_command("quit")
+        log.info("Send command: quit")
+        self.sock.sendall(b"quit\n")
+        self.close()
+
+
+# Retries asyncio.open_connection until {port} is listening.
+async def open_renode_connection(host, port, timeout):
+    deadline = time.monotonic() + timeout
+    delay = 0.05
+    while True:
+        try:
+            return await asyncio.open_connection(host, port, limit=1 << 20)
+        except ConnectionRefusedError:
+            if time.monotonic() + delay > deadline:
+                raise
+            await asyncio.sleep(delay)
+            delay = min(2 * delay, 1.0)
+
+
+class AsyncRenodeMonitor(object):
+    """asyncio version of RenodeMonitor, so one event loop can drive the
+    monitors of several renode instances."""
+
+    def __init__(self, host="127.0.0.1", port=1234, timeout=60.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.buffer = bytearray()
+        self.machine = None
+
+    async def connect(self, timeout=60.0):
+        self.reader, self.writer = await open_renode_connection(
+            self.host, self.port, timeout)
+        self.buffer.clear()
+        await asyncio.wait_for(self.read_reply(), timeout)
+
+    async def close(self):
+        if self.writer:
+            self.writer.close()
+            await self.writer.wait_closed()
+            self.writer = None
+
+    async def read_reply(self):
+        while True:
+            taken = take_reply(self.buffer)
+            if taken:
+                reply, self.machine = taken
+                return reply
+            data = await self.reader.read(65536)
+            if not data:
+                raise ConnectionError("Renode monitor closed the connection")
+            self.buffer += clean_monitor_output(data)
+
+    async def send_commands(self, commands, timeout=None):
+        for command in commands:
+            log.info("Send command: %s", command)
+        self.writer.write("".join("%s\n" % c for c in commands).encode())
+        replies = []
+        for command in commands:
+            reply = strip_echo(command, await asyncio.wait_for(
+                self.read_reply(), timeout or self.timeout))
+            if reply:
+                log.info(reply)
+            replies.append(reply)
+        return replies
+
+    async def send_command(self, command, timeout=None):
+        return (await self.send_commands([command], timeout))[0]
+
+
+class AsyncUart(object):
+    """Client for a CreateServerSocketTerminal port. With {log_path} every
+    byte received is also appended to that file; the writes happen on a
+    worker thread so a slow disk never stalls the reader."""
+
+    def __init__(self, host="127.0.0.1", port=3456, log_path=""):
+        self.host = host
+        self.port = port
+        self.log_path = log_path
+        self.reader = None
+        self.writer = None
+        self.log_queue = None
+        self.log_task = None
+
+    async def connect(self, timeout=60.0):
+        self.reader, self.writer = await open_renode_connection(
+            self.host, self.port, timeout)
+        if self.log_path:
+            self.log_queue = asyncio.Queue()
+            self.log_task = asyncio.create_task(self.write_log())
+
+    async def write_log(self):
+        loop = asyncio.get_running_loop()
+        with open(self.log_path, "ab") as log_file:
+            done = False
+            while not done:
+                chunks = [await self.log_queue.get()]
+                # Coalesce whatever arrived during the previous write
+                while not self.log_queue.empty():
+                    chunks.append(self.log_queue.get_nowait())
+                if chunks[-1] is None:
+                    chunks.pop()
+                    done = True
+                data = b"".join(chunks)
+                await loop.run_in_executor(None, log_file.write, data)
+                await loop.run_in_executor(None, log_file.flush)
+
+    async def read(self, size=65536):
+        data = await self.reader.read(size)
+        if data and self.log_queue is not None:
+            self.log_queue.put_nowait(data)
+        return data
+
+    async def write(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def close(self):
+        if self.log_queue is not None:
+            self.log_queue.put_nowait(None)
+            await self.log_task
+            self.log_queue = None
+        if self.writer:
+            self.writer.close()
+            await self.writer.wait_closed()
+            self.writer = None
+
+
+# Shows the first of {uarts} on the terminal and sends it what is typed,
+# while the others are read (and logged) in the background. Returns when the
+# console UART closes or stdin reaches EOF.
+async def interact(uarts, timeout=60.0):
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*[uart.connect(timeout) for uart in uarts])
+    console = uarts[0]
+    stdin = sys.stdin.fileno()
+    typed = asyncio.Queue()
+    loop.add_reader(stdin, lambda: typed.put_nowait(os.read(stdin, 65536)))
+
+    async def show(uart, output):
+        while True:
+            data = await uart.read()
+            if not data:
+                return
+            if output:
+                output.write(data)
+                output.flush()
+
+    async def type_lines():
+        while True:
+            data = await typed.get()
+            if not data:
+                return
+            await console.write(data)
+
+    tasks = [asyncio.create_task(show(console, sys.stdout.buffer)),
+             asyncio.create_task(type_lines())]
+    tasks += [asyncio.create_task(show(uart, None)) for uart in uarts[1:]]
+    try:
+        await asyncio.wait(tasks[:2], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        loop.remove_reader(stdin)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for uart in uarts:
+            await uart.close()
+
+
+# Renode log lines look like "12:00:00.0000 [INFO] sysbus.uart: ...".
+RENODE_LOG_SOURCE = re.compile(rb"\[[A-Z]+\] ([^:\s]+):")
+
+
+class RenodeLogPump(object):
+    """Drains renode's output in large reads so a chatty peripheral can never
+    fill the pipe and stall the simulation. Output goes to {log_path} in one
+    write per read, rotated at {max_bytes}, and to the logger at no more than
+    {rate} lines a second; lines over the rate are only counted as dropped.
+    {sampling} maps a peripheral name to N to keep one of its lines in N, or
+    to 0 to filter it out completely. Inside tee_to() the raw output is also
+    copied to another file, such as the log of the test a pooled renode is
+    running."""
+
+    def __init__(self, log_path="", rate=200, sampling=None,
+                 max_bytes=64 << 20, backups=3, read_size=1 << 16):
+        self.log_path = log_path
+        self.rate = rate
+        self.sampling = sampling or {}
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.buffer = bytearray(read_size)
+        self.log_file = None
+        self.seen = collections.Counter()
+        self.tokens = rate
+        self.refilled = None
+        self.start = None
+        self.lines = 0
+        self.filtered = 0
+        self.dropped = 0
+        self.bytes = 0
+        self.tee = None
+        self.tee_lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def tee_to(self, tee_file):
+        with self.tee_lock:
+            self.tee = tee_file
+        try:
+            yield
+        finally:
+            with self.tee_lock:
+                self.tee = None
+
+    def run(self, stream):
+        self.start = self.refilled = time.monotonic()
+        if self.log_path:
+            self.log_file = open(self.log_path, "ab")
+        view = memoryview(self.buffer)
+        partial = b""
+        try:
+            while True:
+                size = stream.readinto1(view)
+                if not size:
+                    break
+                with self.tee_lock:
+                    if self.tee is not None:
+                        self.tee.write(view[:size])
+                        self.tee.flush()
+                data = partial + view[:size]
+                end = data.rfind(b"\n") + 1
+                partial = data[end:]
+                if end:
+                    self.handle(data[:end])
+            if partial:
+                self.handle(partial + b"\n")
+        finally:
+            if self.log_file:
+                self.log_file.close()
+
+    def keep(self, line):
+        match = RENODE_LOG_SOURCE.search(line)
+        if not match:
+            return True
+        name = match.group(1).decode(errors="replace")
+        every = self.sampling.get(name)
+        if every is None:
+            return True
+        if every == 0:
+            return False
+        self.seen[name] += 1
+        return (self.seen[name] - 1) % every == 0
+
+    def handle(self, data):
+        count = data.count(b"\n")
+        self.lines += count
+        self.bytes += len(data)
+        if self.sampling:
+            kept = [line for line in data.splitlines(keepends=True)
+                    if self.keep(line)]
+            self.filtered += count - len(kept)
+            count = len(kept)
+            data = b"".join(kept)
+        if not count:
+            return
+        self.write(data)
+        if log.isEnabledFor(logging.INFO):
+            self.show(data, count)
+
+    def write(self, data):
+        if not self.log_file:
+            return
+        if self.log_file.tell() + len(data) > self.max_bytes:
+            self.rotate()
+        self.log_file.write(data)
+        self.log_file.flush()
+
+    def rotate(self):
+        self.log_file.close()
+        for n in range(self.backups - 1, 0, -1):
+            if os.path.exists("%s.%d" % (self.log_path, n)):
+                os.replace("%s.%d" % (self.log_path, n),
+                           "%s.%d" % (self.log_path, n + 1))
+        os.replace(self.log_path, self.log_path + ".1")
+        self.log_file = open(self.log_path, "ab")
+
+    # Token bucket: {rate} lines a second, with up to a second of burst.
+    def show(self, data, count):
+        now = time.monotonic()
+        self.tokens = min(self.rate,
+                          self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+        allowed = min(count, int(self.tokens))
+        self.tokens -= allowed
+        self.dropped += count - allowed
+        if allowed:
+            for line in data.split(b"\n", allowed)[:allowed]:
+                log.info(line.decode(errors="replace"))
+
+    def stats(self):
+        elapsed = max(time.monotonic() - (self.start or time.monotonic()),
+                      1e-9)
+        return {"lines": self.lines, "bytes": self.bytes,
+                "lines_per_sec": self.lines / elapsed,
+                "filtered": self.filtered, "dropped": self.dropped}
 
 
 class RenodeThread(threading.Thread):
-    def __init__(self, script=""):
+    def __init__(self, script="", port=1234, pump=None, instance=None):
         super(RenodeThread, self).__init__()
         self.script = script
+        self.port = port
+        self.pump = pump or RenodeLogPump()
+        # Pool slot and tests run so far, for RenodePool
+        self.instance = instance
+        self.runs = 0
         self.proc = None
         self.connect()
-        self.monitor = RenodeMonitor()
-        time.sleep(2.0)
-        self.monitor.connect()
+        self.monitor = RenodeMonitor(port=port)
+        try:
+            self.monitor.connect()
+        except OSError:
+            self.kill()
+            raise
         if script:
             self.monitor.execute_script(script)
 
     def connect(self):
         cmd = ["mono",
                "%s/host/renode/Renode.exe" % ENVIRON['OUT'],
+               "--port", str(self.port),
                "--disable-xwt"]
         log.info("Runnning renode command '%s'", " ".join(cmd))
         self.proc = subprocess.Popen(cmd, env=ENVIRON,
                                      stdout=subprocess.PIPE,
                                      stderr=subprocess.STDOUT)
 
+    # The pump returns once renode closes its output, on exit.
     def run(self):
-        while True:
-            output = self.proc.stdout.readline()
-            if output:
-                log.info(output)
-            if self.proc.poll() is not None:
-                break
+        self.pump.run(self.proc.stdout)
         log.info("Waiting on renode to exit.")
         self.proc.wait()
-        log.info("Renode has exited.")
+        log.info("Renode has exited. Output: %d lines (%.0f/s), %d filtered, "
+                 "%d not shown", *[self.pump.stats()[key] for key in
+                                   ("lines", "lines_per_sec", "filtered",
+                                    "dropped")])
 
     def kill(self):
         if self.proc:
@@ -137,28 +560,109 @@ class RenodeThread(threading.Thread):
                 self.proc.kill()
 
 
+class RenodePool(object):
+    """Keeps a renode process started for each of {instances}, with its
+    monitor on port {base_port} + instance, and hands them out one test at a
+    time. A returned process is cleared for the next test and restarted after
+    {max_runs} tests, so tests pay for their script but not mono startup.
+    A process that fails to start leaves its instance number in the pool, and
+    the next acquire() of it tries again."""
+
+    def __init__(self, instances, max_runs=50, base_port=1234):
+        self.max_runs = max_runs
+        self.base_port = base_port
+        self.free = queue.Queue()
+        instances = list(instances)
+        with concurrent.futures.ThreadPoolExecutor(len(instances)) as pool:
+            for renode in pool.map(self.try_spawn, instances):
+                self.free.put(renode)
+
+    def spawn(self, instance):
+        renode = RenodeThread(port=self.base_port + instance,
+                              instance=instance)
+        renode.start()
+        return renode
+
+    def try_spawn(self, instance):
+        """Returns a started renode for {instance}, or just {instance} if it
+        did not start."""
+        try:
+            return self.spawn(instance)
+        except OSError as e:
+            log.warning("Renode instance %d did not start: %s", instance, e)
+            return instance
+
+    @contextlib.contextmanager
+    def acquire(self, timeout=600):
+        """Yields a free renode, waiting up to {timeout} seconds for one.
+        Raises OSError if none is free in time or it does not start."""
+        try:
+            renode = self.free.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError("No renode free after %ds" % timeout) from None
+        if isinstance(renode, int):
+            try:
+                renode = self.spawn(renode)
+            except OSError:
+                self.free.put(renode)
+                raise
+        try:
+            yield renode
+        finally:
+            self.free.put(self.recycle(renode))
+
+    def recycle(self, renode):
+        renode.runs += 1
+        if renode.runs < self.max_runs and renode.is_alive():
+            try:
+                renode.monitor.clear()
+                return renode
+            except OSError:
+                log.warning("Renode instance %d did not clear, restarting",
+                            renode.instance)
+        renode.kill()
+        renode.join()
+        return self.try_spawn(renode.instance)
+
+    def close(self):
+        while not self.free.empty():
+            renode = self.free.get()
+            if isinstance(renode, int):
+                continue
+            renode.kill()
+            renode.join()
+
+
 def main():
+    log.addHandler(logging.StreamHandler())
+    log.setLevel(logging.INFO)
     args = parser.parse_args()
     print(args)
-    renode = RenodeThread(args.script_file)
+    sampling = {}
+    for spec in args.log_sampling:
+        name, _, every = spec.partition("=")
+        sampling[name] = int(every)
+    pump = RenodeLogPump(args.renode_log, args.renode_log_rate, sampling)
+    renode = RenodeThread(args.script_file, pump=pump)
     renode.start()
 
     if args.connect_uart or args.setup_uart:
         renode.monitor.setup_uart(uart_name=args.uart_name)
-        time.sleep(0.5)
         renode.monitor.start()
 
     if args.connect_uart:
         log.info("\n\nConnect to UART\n\n")
-        tn = telnetlib.Telnet('localhost', 3456)
-        tn.close()
-        tn.open('localhost', 3456)
+        uarts = [AsyncUart(port=3456, log_path=args.uart_log)]
+        for spec in args.log_uarts:
+            port, _, path = spec.partition("=")
+            uarts.append(AsyncUart(port=int(port), log_path=path))
         try:
-            tn.interact()
+            asyncio.run(interact(uarts))
         except KeyboardInterrupt:
             renode.kill()
 
     if args.interactive:
+        import IPython
         IPython.embed()
         renode.kill()
 
@@ -19,18 +19,40 @@ quick_sim.py is a tool to quickly launch simulations
 
 It does a fuzzy search using fzf on the scripts directory
 and then executes them using renode.
+
+`quick_sim.py farm --manifest FILE` instead runs a batch of simulations from a
+JSON manifest across several renode instances and reports pass/fail.
 """
 import argparse
+import concurrent.futures
+import contextlib
+import fnmatch
+import json
 import logging
 import os
+import queue
+import re
+import signal
+import socket
 import subprocess
+import sys
+import time
 from glob import iglob
 
 from pyfzf.pyfzf import FzfPrompt
 
+from launch_renode import RenodeMonitor, RenodePool
+from test_report import load_json, save_json, write_junit
+from uart_expect import Expect, UartExpect
+
 parser = argparse.ArgumentParser(
     description="Start renode simulation.")
 
+parser.add_argument('mode', nargs='?', choices=['sim', 'farm'],
+                    help='sim (default) launches one simulation, farm runs '
+                    'the simulations listed in --manifest',
+                    default='sim')
+
 parser.add_argument('--script', dest='script_file',
                     help='script file to run within renode',
                     default="")
@@ -47,6 +69,39 @@ parser.add_argument('--start-sim', dest='start_sim',
                     help='start the simulator',
                     default=False, action="store_true")
 
+parser.add_argument('--instances', dest='instances', type=int,
+                    help='number of renode instances to run side by side, '
+                    'each with its own ports',
+                    default=1)
+
+parser.add_argument('--rescan', dest='rescan',
+                    help='ignore the cached file index and rebuild it',
+                    default=False, action="store_true")
+
+parser.add_argument('--manifest', dest='manifest',
+                    help='farm: JSON list of {"script", "elf", "expect", '
+                    '"fail", "timeout", "inactivity_timeout"} simulations '
+                    'to run',
+                    default="")
+
+parser.add_argument('-j', '--jobs', dest='jobs', type=int,
+                    help='farm: number of renode instances to run at once',
+                    default=os.cpu_count() // 4 or 1)
+
+parser.add_argument('--warm', dest='warm',
+                    help='farm: keep a renode process started per job slot '
+                    'and reuse it across simulations', default=False,
+                    action='store_true')
+
+parser.add_argument('--recycle', dest='recycle', type=int,
+                    help='farm: restart a warm renode after this many '
+                    'simulations', default=50)
+
+parser.add_argument('--report', dest='report',
+                    help='farm: write results here, JUnit XML if the name '
+                    'ends in .xml, JSON otherwise',
+                    default="")
+
 parser.add_argument("-v", "--verbose", help="increase output verbosity",
                     action="store_true")
 
@@ -57,47 +112,405 @@ if args.verbose:
     logging.basicConfig(level=logging.DEBUG)
 
 
-def prompt_for_file(search_paths):
-    """ Prompt user for a file using a list of search paths."""
+class FileIndex:
+    """ Persistent index of candidate files for the fzf prompt.
+
+    For every search pattern the index keeps each directory's mtime along with
+    its subdirectories and matching files. On refresh only directories whose
+    mtime changed are listed again, so unchanged parts of out/ cost one stat
+    per directory instead of a full walk. It also remembers when each file was
+    last picked so recent choices are offered first.
+    """
+
+    def __init__(self, path, rescan=False):
+        self.path = path
+        self.data = {"patterns": {}, "history": {}}
+        if not rescan:
+            self.data = load_json(path, self.data)
+
+    def save(self):
+        try:
+            save_json(self.path, self.data)
+        except OSError as e:
+            logging.warning("Could not save file index: %s", e)
+
+    def scan(self, pattern):
+        """ Returns the files matching a pattern of the form root/**/name or
+        root/name, refreshing the cached directory listings."""
+        parts = pattern.split("/")
+        name_pattern = parts[-1]
+        recursive = "**" in parts[:-1]
+        root = "/".join(parts[:parts.index("**")] if recursive else parts[:-1])
+        if any(c in root for c in "*?["):
+            return list(iglob(pattern, recursive=True))
+
+        dirs = self.data["patterns"].setdefault(pattern, {})
+        seen = set()
+        files = []
+        stack = [root or "."]
+        while stack:
+            path = stack.pop()
+            seen.add(path)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+            entry = dirs.get(path)
+            if entry is None or entry["mtime_ns"] != mtime:
+                entry = self.list_dir(path, mtime, name_pattern)
+                dirs[path] = entry
+            files += [os.path.join(path, name) for name in entry["files"]]
+            if recursive:
+                stack += [os.path.join(path, name) for name in entry["subdirs"]]
+
+        # Drop directories that have disappeared
+        for path in set(dirs) - seen:
+            del dirs[path]
+        return files
+
+    @staticmethod
+    def list_dir(path, mtime, name_pattern):
+        subdirs = []
+        files = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    # Like glob, skip hidden files and directories
+                    if entry.name.startswith("."):
+                        continue
+                    if entry.is_dir():
+                        subdirs.append(entry.name)
+                    elif fnmatch.fnmatch(entry.name, name_pattern):
+                        files.append(entry.name)
+        except OSError:
+            pass
+        return {"mtime_ns": mtime, "subdirs": subdirs, "files": files}
 
-    paths = []
+    def candidates(self, search_paths):
+        """ Matching files, most recently picked first."""
+        paths = []
+        for pattern in search_paths:
+            paths += self.scan(pattern)
+        paths = [os.path.normpath(p) for p in paths]
+        history = self.data["history"]
+        return sorted(set(paths), key=lambda p: (-history.get(p, 0), p))
 
-    for scripts  in [iglob(p, recursive=True) for p in search_paths]:
-        paths += scripts
+    def record_use(self, path):
+        self.data["history"][os.path.normpath(path)] = time.time()
+
+
+def prompt_for_file(search_paths, index):
+    """ Prompt user for a file using a list of search paths."""
+
+    paths = index.candidates(search_paths)
+    index.save()
 
     fzf = FzfPrompt()
     script_file = fzf.prompt(paths)[0]
+    index.record_use(script_file)
+    index.save()
     return script_file
 
 
-def launch_renode(script_file, elf_file, start=False):
-    """ Given a script execute it in our environment using renode"""
+class RenodeSupervisor:
+    """ Runs renode children and blocks in wait4 until they exit, forwarding
+    SIGINT and SIGTERM to them."""
+
+    def __init__(self):
+        self.children = {}
+        self.results = []
+
+    def spawn(self, name, cmd):
+        logging.info("Executing command: %s", " ".join(cmd))
+        proc = subprocess.Popen(cmd, env=env)
+        self.children[proc.pid] = (name, proc, time.monotonic())
+        return proc
+
+    def forward_signal(self, signum, _frame):
+        logging.info("Forwarding %s to renode", signal.Signals(signum).name)
+        for _, proc, _ in self.children.values():
+            proc.send_signal(signum)
+
+    def wait(self):
+        """ Waits for every child to exit and returns their exit status with
+        wall and CPU time."""
+        handlers = {signum: signal.signal(signum, self.forward_signal)
+                    for signum in (signal.SIGINT, signal.SIGTERM)}
+        try:
+            while self.children:
+                try:
+                    pid, status, rusage = os.wait4(-1, 0)
+                except ChildProcessError:
+                    break
+                if pid not in self.children:
+                    continue
+                name, proc, start = self.children.pop(pid)
+                proc.returncode = os.waitstatus_to_exitcode(status)
+                result = {
+                    "name": name,
+                    "returncode": proc.returncode,
+                    "wall_seconds": time.monotonic() - start,
+                    "user_seconds": rusage.ru_utime,
+                    "system_seconds": rusage.ru_stime,
+                }
+                logging.info(
+                    "%s exited with %d after %.1fs (%.1fs user, %.1fs system)",
+                    name, proc.returncode, result["wall_seconds"],
+                    rusage.ru_utime, rusage.ru_stime)
+                self.results.append(result)
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+        return self.results
+
+
+def renode_ports(instance):
+    """ Ports for the given instance, following generate-renode-port-cmd.sh:
+    (monitor port, $term_port, $gdb_port)."""
+    return 1234 + instance, 3456 + instance, 3333 + instance
+
+
+def renode_command(script_file, elf_file, start=False, instance=None):
+    """ Builds the renode command line. With an instance number the monitor,
+    UART and GDB ports are offset so several instances can run at once."""
 
     cmd = ["mono",
-            "%s/host/renode/Renode.exe" % env['OUT']]
+           "%s/host/renode/Renode.exe" % env['OUT']]
+
+    if instance is not None:
+        monitor_port, term_port, gdb_port = renode_ports(instance)
+        cmd += ["--port", str(monitor_port),
+                "-e", "$term_port=%d; $gdb_port=%d" % (term_port, gdb_port)]
 
     if not elf_file == "":
-        cmd.append(r'-e"\$bin=@%s"' % elf_file)
+        cmd += ["-e", "$bin=@%s" % elf_file]
 
-    cmd.append('-e"i @%s"' % script_file)
+    cmd += ["-e", "i @%s" % script_file]
     if start:
-        cmd.append('-e"start"')
+        cmd += ["-e", "start"]
 
     cmd.append("--disable-xwt")
-    cmd = " ".join(cmd)
-    logging.info("Executing command: %s", cmd)
+    return cmd
 
+
+def launch_renode(script_file, elf_file, start=False, instances=1):
+    """ Given a script execute it in our environment using renode"""
+
+    supervisor = RenodeSupervisor()
+    for instance in range(instances):
+        cmd = renode_command(script_file, elf_file, start,
+                             instance if instances > 1 else None)
+        supervisor.spawn("renode-%d" % instance, cmd)
+    results = supervisor.wait()
+    logging.info("Exiting simulation")
+    return all(result["returncode"] == 0 for result in results)
+
+class FarmJob:
+    """ One simulation from a farm manifest."""
+
+    default_timeout = 300
+
+    def __init__(self, spec, number):
+        """ Raises ValueError if {spec} is not a valid manifest entry."""
+        if not isinstance(spec, dict):
+            raise ValueError("not a JSON object")
+        for key in ("script", "expect"):
+            if not isinstance(spec.get(key), str):
+                raise ValueError("needs a \"%s\" string" % key)
+        for key in ("timeout", "inactivity_timeout"):
+            if not isinstance(spec.get(key, 0), (int, float)):
+                raise ValueError("\"%s\" is not a number" % key)
+        self.script = spec["script"]
+        self.elf = spec.get("elf", "")
+        self.name = spec.get("name") or "%d-%s" % (
+            number, os.path.splitext(os.path.basename(self.elf or
+                                                      self.script))[0])
+        try:
+            self.expects = [Expect("expect", spec["expect"], "pass")]
+            if "fail" in spec:
+                self.expects.append(Expect("fail", spec["fail"], "fail"))
+        except (TypeError, re.error) as e:
+            raise ValueError("bad pattern: %s" % e) from e
+        self.timeout = spec.get("timeout", self.default_timeout)
+        self.inactivity_timeout = spec.get("inactivity_timeout")
+
+
+def connect_uart(port, deadline):
+    """ Connects to a renode UART socket terminal once it is listening."""
+    delay = 0.05
+    while True:
+        try:
+            return socket.create_connection(("localhost", port), timeout=1)
+        except OSError:
+            if time.monotonic() + delay > deadline:
+                raise
+            time.sleep(delay)
+            delay = min(2 * delay, 1.0)
+
+
+def log_monitor(log, commands, replies):
+    for command, reply in zip(commands, replies):
+        log.write(("> %s\n%s" % (command, reply)).encode())
+    log.flush()
+
+
+@contextlib.contextmanager
+def cold_renode(job, slots, log):
+    """ Starts a renode process for {job} in a free slot, with the machine
+    paused, and stops it when the job is done. Yields the instance number and
+    a function that starts the machine."""
+    instance = slots.get()
+    proc = None
+    monitor = None
     try:
-        proc = subprocess.Popen(cmd, env=env, shell=True)
-        while True:
-            pass
-    except KeyboardInterrupt:
-        proc.wait()
-        logging.info("Exiting simulation")
+        cmd = renode_command(job.script, job.elf, False, instance)
+        logging.info("%s: %s", job.name, " ".join(cmd))
+        proc = subprocess.Popen(cmd, env=env, stdin=subprocess.DEVNULL,
+                                stdout=log, stderr=subprocess.STDOUT)
+        monitor_port, _, _ = renode_ports(instance)
+        monitor = RenodeMonitor(port=monitor_port, timeout=job.timeout)
+
+        def start():
+            monitor.connect(job.timeout)
+            log_monitor(log, ["start"], [monitor.send_command("start")])
+
+        yield instance, start
+    finally:
+        if monitor is not None:
+            monitor.close()
+        if proc is not None:
+            proc.terminate()
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+        slots.put(instance)
+
+
+@contextlib.contextmanager
+def warm_renode(job, renode_pool, log):
+    """ Loads {job} on an already started renode from the pool, which clears
+    it when the job is done. Yields the instance number and a function that
+    starts the machine."""
+    with renode_pool.acquire(job.timeout) as renode, \
+            renode.pump.tee_to(log):
+        _, term_port, gdb_port = renode_ports(renode.instance)
+        commands = ["$term_port=%d; $gdb_port=%d" % (term_port, gdb_port)]
+        if job.elf:
+            commands.append("$bin=@%s" % job.elf)
+        commands.append("i @%s" % job.script)
+        log_monitor(log, commands,
+                    renode.monitor.send_commands(commands, job.timeout))
+
+        def start():
+            log_monitor(log, ["start"],
+                        [renode.monitor.send_command("start", job.timeout)])
+
+        yield renode.instance, start
+
+
+def run_farm_job(job, slots, log_dir, renode_pool=None):
+    """ Runs one job on a warm renode from {renode_pool} if there is one,
+    otherwise on a new renode in a free instance slot. The machine is only
+    started once the UART is connected, so no early output is lost."""
+    result = {"name": job.name, "script": job.script, "elf": job.elf,
+              "instance": None, "status": "error", "detail": ""}
+    start = time.monotonic()
+    deadline = start + job.timeout
+    log_path = os.path.join(log_dir, job.name + ".log")
+    uart_path = os.path.join(log_dir, job.name + ".uart.log")
+    try:
+        with open(log_path, "wb") as log, open(uart_path, "wb") as transcript:
+            if renode_pool is None:
+                simulation = cold_renode(job, slots, log)
+            else:
+                simulation = warm_renode(job, renode_pool, log)
+            with simulation as (instance, start_machine):
+                result["instance"] = instance
+                _, term_port, _ = renode_ports(instance)
+                with connect_uart(term_port, deadline) as uart:
+                    start_machine()
+                    expect = UartExpect(
+                        job.expects, deadline - time.monotonic(),
+                        job.inactivity_timeout, transcript=transcript)
+                    outcome = expect.wait_fd(uart)
+                result["status"] = outcome.status
+                result["detail"] = outcome.detail
+                result["matches"] = outcome.as_dict()["matches"]
+    except OSError as e:
+        result["detail"] = str(e)
+    result["seconds"] = time.monotonic() - start
+    result["log"] = log_path
+    result["uart_log"] = uart_path
+    print("%-40s %-8s %7.1fs" % (job.name, result["status"],
+                                 result["seconds"]), flush=True)
+    return result
+
+
+def run_farm(manifest_path, jobs, report, warm=False, recycle=50):
+    """ Runs every simulation in the manifest, at most {jobs} at a time.
+    Instance n uses the ports of generate-renode-port-cmd.sh for renode port
+    1234 + n, starting at 1 to stay clear of an interactive simulation.
+    With {warm} the renode processes are started once and reused."""
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        specs = json.load(f)
+    farm_jobs = []
+    invalid = []
+    for n, spec in enumerate(specs):
+        try:
+            farm_jobs.append(FarmJob(spec, n))
+        except ValueError as e:
+            print("Manifest entry %d: %s" % (n, e))
+            invalid.append({
+                "name": "%d-invalid" % n,
+                "script": spec.get("script", "") if isinstance(spec, dict)
+                          else "",
+                "elf": "", "instance": None, "status": "error",
+                "detail": "invalid manifest entry: %s" % e, "seconds": 0.0,
+                "log": "", "uart_log": ""})
+
+    log_dir = os.path.join(env.get("OUT", "out"), "quick_sim", "farm")
+    os.makedirs(log_dir, exist_ok=True)
+    slots = queue.Queue()
+    for slot in range(jobs):
+        slots.put(slot + 1)
+
+    start = time.monotonic()
+    renode_pool = None
+    if warm:
+        renode_pool = RenodePool(range(1, jobs + 1), recycle)
+        print("Started %d renode instances in %.1fs" % (
+            jobs, time.monotonic() - start))
+    try:
+        with concurrent.futures.ThreadPoolExecutor(jobs) as pool:
+            results = invalid + list(pool.map(
+                lambda job: run_farm_job(job, slots, log_dir, renode_pool),
+                farm_jobs))
+    finally:
+        if renode_pool is not None:
+            renode_pool.close()
+    passed = sum(result["status"] == "pass" for result in results)
+    print("%d/%d passed in %.1fs" % (passed, len(results),
+                                    time.monotonic() - start))
+
+    if report.endswith(".xml"):
+        write_junit(results, report, "quick_sim",
+                    lambda result: os.path.basename(result["script"]),
+                    lambda result: result["uart_log"] and
+                    "UART log: %s" % result["uart_log"])
+    elif report:
+        with open(report, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    return passed == len(results)
+
 
 def main():
     """ Main entry point for quick_sim.py"""
 
+    manifest = os.path.abspath(args.manifest) if args.manifest else ""
+    report = os.path.abspath(args.report) if args.report else ""
+
     logging.debug("Change directory to ROOTDIR")
     if "ROOTDIR" in env:
         os.chdir(env['ROOTDIR'])
@@ -105,13 +518,22 @@ def main():
     else:
         parser.error("Please source setup script: source build/setup.sh")
 
+    if args.mode == "farm":
+        if not manifest:
+            parser.error("farm mode needs --manifest")
+        sys.exit(0 if run_farm(manifest, max(args.jobs, 1), report,
+                             args.warm, args.recycle) else 1)
+
     logging.info("Looking for simulation scripts to run...")
 
     search_path_names = ["sim/config/**/*.resc", "out/renode_configs/*.resc"]
+    index = FileIndex(
+        os.path.join(env.get("OUT", "out"), "quick_sim", "file_index.json"),
+        args.rescan)
 
     script_file = args.script_file
     if script_file == "":
-        script_file = prompt_for_file(search_path_names)
+        script_file = prompt_for_file(search_path_names, index)
 
     logging.debug("Selected %s", script_file)
     if not os.path.exists(script_file):
@@ -121,13 +543,13 @@ def main():
     if args.prompt_elf:
         search_path_names = ["out/**/*.elf"]
         if elf_file == "":
-            elf_file = prompt_for_file(search_path_names)
+            elf_file = prompt_for_file(search_path_names, index)
 
         logging.debug("Selected elf %s", elf_file)
         if not os.path.exists(elf_file):
             parser.error("Selected elf does not exits.")
 
-    launch_renode(script_file, elf_file, args.start_sim)
+    launch_renode(script_file, elf_file, args.start_sim, args.instances)
 
 if __name__ == "__main__":
     main()
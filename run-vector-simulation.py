@@ -15,65 +15,767 @@
 # limitations under the License.
 
 import argparse
+import concurrent.futures
+import hashlib
+import json
 import logging
+import multiprocessing.util
+import os
+import select
+import shlex
+import shutil
+import socket
+import struct
 import subprocess
-import re
+import tempfile
+import time
+
+from launch_renode import RenodeMonitor
+from test_report import load_json, save_json, write_junit
+from uart_expect import UartExpect, test_status_expects
 
 logger = logging.getLogger(__name__)
 
+OUT = os.environ.get('OUT', 'out')
+
+# Springbok programs start at the beginning of its TCM.
+SPRINGBOK_TCM = 0x34000000
+
 
 class SimulationFailedError(Exception):
     pass
 
 
+def elf_entry(path):
+    """Returns the entry point of a 32-bit little endian ELF."""
+    with open(path, 'rb') as f:
+        header = f.read(28)
+    if len(header) < 28 or header[:4] != b'\x7fELF':
+        raise SimulationFailedError('%s is not an ELF file' % path)
+    return struct.unpack_from('<I', header, 24)[0]
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def elf_load_segments(path):
+    """Returns (physical address, contents) of the PT_LOAD segments of a
+    32-bit little endian ELF, zero filled to their size in memory so .bss
+    is cleared too."""
+    with open(path, 'rb') as f:
+        elf = f.read()
+    phoff, = struct.unpack_from('<I', elf, 28)
+    phentsize, phnum = struct.unpack_from('<HH', elf, 42)
+    segments = []
+    for n in range(phnum):
+        p_type, offset, _, paddr, filesz, memsz = struct.unpack_from(
+            '<6I', elf, phoff + n * phentsize)
+        if p_type == 1 and memsz:
+            segments.append((paddr, elf[offset:offset + filesz] +
+                             bytes(max(memsz - filesz, 0))))
+    return segments
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+class Simulator:
+    """A simulator backend. Subclasses build the command line and say where
+    the UART output appears; run() waits there for the test_status.c result
+    and always stops the simulator afterwards."""
+
+    name = None
+    default_path = None
+    # Where the simulator's own output goes, when it is not the UART
+    stdout = subprocess.PIPE
+    cwd = None
+    # Seconds of the last run spent starting the simulator, when known
+    startup_seconds = None
+
+    def __init__(self, args, path=None):
+        self.args = args
+        self.path = path or self.default_path
+
+    def available(self):
+        return bool(self.path) and os.path.exists(self.path)
+
+    def supports(self, _vector_elf):
+        return True
+
+    def check_path(self):
+        if not self.path:
+            raise SimulationFailedError(
+                '%s has no default path, pass --%s-path or --simulator-path' %
+                (self.name, self.name))
+
+    def fingerprint(self):
+        """Identifies the simulator build for the result cache."""
+        self.check_path()
+        return '%s:%s' % (self.name, file_digest(self.path))
+
+    def command(self, boot_elf, vector_elf):
+        raise NotImplementedError
+
+    # Waits for the result on the simulator's stdout by default.
+    def wait(self, proc, expect):
+        return expect.wait_fd(proc.stdout)
+
+    def run(self, boot_elf, vector_elf):
+        self.check_path()
+        cmd = self.command(boot_elf, vector_elf)
+        logger.debug('%s: %s', self.name, ' '.join(cmd))
+        expect = UartExpect(test_status_expects(), self.args.timeout,
+                            self.args.inactivity_timeout)
+        proc = subprocess.Popen(
+            cmd, bufsize=0, cwd=self.cwd,
+            stdout=self.stdout,
+            stderr=subprocess.DEVNULL)
+        try:
+            return self.wait(proc, expect)
+        finally:
+            proc.kill()
+            proc.wait()
+
+
+class QemuSimulator(Simulator):
+    """With --persistent-qemu one QEMU per process and boot ELF is kept
+    running and each test only loads its own ELF into it."""
+
+    name = 'qemu'
+    default_path = os.path.join(OUT, 'host/qemu/riscv32-softmmu',
+                                'qemu-system-riscv32')
+
+    def command(self, boot_elf, vector_elf):
+        return [self.path,
+            '-display', 'none',
+            '-cpu', 'rv32,x-v=true,vlen=512,vext_spec=v1.0',
+            '-M', 'opentitan',
+            '-kernel', vector_elf,
+            '-bios', boot_elf,
+            '--chardev', 'file,id=s1,path=/dev/stdout',
+            '-serial', 'chardev:s1']
+
+    def run(self, boot_elf, vector_elf):
+        if not self.args.persistent_qemu:
+            return super().run(boot_elf, vector_elf)
+        key = (self.path, boot_elf)
+        if key not in PERSISTENT_QEMU:
+            PERSISTENT_QEMU[key] = PersistentQemu(self, boot_elf)
+        qemu = PERSISTENT_QEMU[key]
+        expect = UartExpect(test_status_expects(), self.args.timeout,
+                            self.args.inactivity_timeout)
+        result = qemu.run(vector_elf, expect)
+        self.startup_seconds = qemu.startup_seconds
+        return result
+
+
+class QmpClient:
+    """Minimal client for QEMU's QMP monitor socket."""
+
+    def __init__(self, path, timeout=30):
+        self.sock = socket.socket(socket.AF_UNIX)
+        self.sock.settimeout(timeout)
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.sock.connect(path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.01)
+        self.reader = self.sock.makefile('rb')
+        self.read_message()
+        self.execute('qmp_capabilities')
+
+    # Skips asynchronous events.
+    def read_message(self):
+        while True:
+            line = self.reader.readline()
+            if not line:
+                raise SimulationFailedError('QEMU closed its QMP socket')
+            message = json.loads(line)
+            if 'event' not in message:
+                return message
+
+    def execute(self, command, **arguments):
+        request = {'execute': command}
+        if arguments:
+            request['arguments'] = arguments
+        self.sock.sendall(json.dumps(request).encode() + b'\n')
+        reply = self.read_message()
+        if 'error' in reply:
+            raise SimulationFailedError('QMP %s: %s' % (
+                command, reply['error'].get('desc')))
+        return reply.get('return')
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+
+class GdbClient:
+    """Just enough of the GDB remote protocol to write guest memory."""
+
+    # Bytes per memory write packet, within QEMU's 4 KiB packet limit
+    chunk_size = 1024
+
+    def __init__(self, port, timeout=30):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.sock = socket.create_connection(('localhost', port),
+                                                     timeout=timeout)
+                break
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.01)
+        self.buffer = b''
+
+    def read_packet(self):
+        while True:
+            start = self.buffer.find(b'$')
+            end = self.buffer.find(b'#', start)
+            if start >= 0 and end >= 0 and len(self.buffer) >= end + 3:
+                data = self.buffer[start + 1:end]
+                self.buffer = self.buffer[end + 3:]
+                self.sock.sendall(b'+')
+                return data
+            chunk = self.sock.recv(4096)
+            if not chunk:
+                raise SimulationFailedError('QEMU closed its gdb socket')
+            self.buffer += chunk
+
+    def command(self, data):
+        checksum = sum(data) & 0xff
+        self.sock.sendall(b'$%s#%02x' % (data, checksum))
+        return self.read_packet()
+
+    # Drops stop notifications QEMU sent while nobody was asking.
+    def drain(self):
+        self.sock.setblocking(False)
+        try:
+            while self.sock.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        finally:
+            self.sock.setblocking(True)
+        self.buffer = b''
+
+    def write_memory(self, address, data):
+        for offset in range(0, len(data), self.chunk_size):
+            chunk = data[offset:offset + self.chunk_size]
+            reply = self.command(b'M%x,%x:%s' % (address + offset, len(chunk),
+                                                 chunk.hex().encode()))
+            if reply != b'OK':
+                raise SimulationFailedError('gdb write at 0x%x failed: %s' % (
+                    address + offset, reply.decode(errors='replace')))
+
+    def close(self):
+        self.sock.close()
+
+
+class PersistentQemu:
+    """A QEMU kept paused between tests. For each test it is reset through
+    QMP, which also restores the boot images, and the test ELF's segments
+    are written through the gdbstub before the machine continues. Memory
+    loaded for an earlier test, including the -kernel image the reset
+    restores, is zeroed first so no test sees another's bytes. The process
+    is killed when its owner exits or a test leaves it in an unknown
+    state."""
+
+    def __init__(self, simulator, boot_elf):
+        self.simulator = simulator
+        self.boot_elf = boot_elf
+        self.proc = None
+        self.qmp = None
+        self.gdb = None
+        self.work_dir = None
+        self.startup_seconds = 0.0
+        # (address, size) of every region a test has been loaded to
+        self.loaded = set()
+        multiprocessing.util.Finalize(self, self.close, exitpriority=10)
+
+    def start(self, vector_elf):
+        start = time.monotonic()
+        self.work_dir = tempfile.mkdtemp(prefix='qemu-')
+        qmp_path = os.path.join(self.work_dir, 'qmp.sock')
+        gdb_port = free_port()
+        cmd = self.simulator.command(self.boot_elf, vector_elf) + [
+            '-S',
+            '-qmp', 'unix:%s,server=on,wait=off' % qmp_path,
+            '-gdb', 'tcp:localhost:%d' % gdb_port]
+        logger.debug('persistent qemu: %s', ' '.join(cmd))
+        self.proc = subprocess.Popen(cmd, bufsize=0,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL)
+        self.qmp = QmpClient(qmp_path)
+        self.gdb = GdbClient(gdb_port)
+        self.loaded = {(address, len(data)) for address, data in
+                       elf_load_segments(vector_elf)}
+        self.startup_seconds = time.monotonic() - start
+
+    def load(self, vector_elf):
+        self.qmp.execute('stop')
+        self.qmp.execute('system_reset')
+        self.gdb.drain()
+        segments = elf_load_segments(vector_elf)
+        for address, size in sorted(self.loaded):
+            self.gdb.write_memory(address, bytes(size))
+        for address, data in segments:
+            self.gdb.write_memory(address, data)
+            self.loaded.add((address, len(data)))
+
+    def drain_output(self):
+        fd = self.proc.stdout.fileno()
+        while select.select([fd], [], [], 0)[0]:
+            if not os.read(fd, 65536):
+                break
+
+    def run(self, vector_elf, expect):
+        try:
+            if self.proc is None or self.proc.poll() is not None:
+                self.close()
+                self.start(vector_elf)
+            else:
+                self.startup_seconds = 0.0
+                self.load(vector_elf)
+            self.drain_output()
+            self.qmp.execute('cont')
+            result = expect.wait_fd(self.proc.stdout)
+        except BaseException:
+            self.close()
+            raise
+        if result.status in ('pass', 'fail'):
+            self.qmp.execute('stop')
+        else:
+            self.close()
+        return result
+
+    def close(self):
+        for client in (self.qmp, self.gdb):
+            if client is not None:
+                try:
+                    client.close()
+                except OSError:
+                    pass
+        self.qmp = self.gdb = None
+        if self.proc is not None:
+            self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+        if self.work_dir is not None:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+            self.work_dir = None
+
+
+# PersistentQemu of this process by (QEMU path, boot ELF)
+PERSISTENT_QEMU = {}
+
+
+class SpikeSimulator(Simulator):
+    """Runs the vector ELF directly, as run-spike-springbok.sh does, so only
+    programs linked for the springbok TCM are supported."""
+
+    name = 'spike'
+    default_path = os.path.join(OUT, 'host/spike/bin/spike')
+
+    def supports(self, vector_elf):
+        return elf_entry(vector_elf) == SPRINGBOK_TCM
+
+    def command(self, boot_elf, vector_elf):
+        return [self.path,
+            '-m0x%x:0x1000000' % SPRINGBOK_TCM,
+            '--varch=vlen:512,elen:32',
+            '--pc=0x%x' % SPRINGBOK_TCM,
+            vector_elf]
+
+
+class RenodeSimulator(Simulator):
+    """Runs --renode-script headless with $bin set to the vector ELF and
+    $boot to the boot ELF, and reads the UART from a socket terminal. The
+    machine is only started once the terminal is connected, since renode
+    drops UART output nobody is connected for."""
+
+    name = 'renode'
+    default_path = os.path.join(OUT, 'host/renode/Renode.exe')
+    stdout = subprocess.DEVNULL
+    term_port = None
+    monitor_port = None
+
+    def available(self):
+        return super().available() and bool(self.args.renode_script)
+
+    def fingerprint(self):
+        return '%s:%s' % (super().fingerprint(),
+                          file_digest(self.args.renode_script))
+
+    def command(self, boot_elf, vector_elf):
+        if not self.args.renode_script:
+            raise SimulationFailedError('renode needs --renode-script')
+        self.term_port = free_port()
+        self.monitor_port = free_port()
+        return ['mono', self.path,
+            '--disable-xwt',
+            '--port', str(self.monitor_port),
+            '-e', '$bin=@%s; $boot=@%s' % (vector_elf, boot_elf),
+            '-e', 'i @%s' % self.args.renode_script,
+            '-e', 'emulation CreateServerSocketTerminal %d "term" false' %
+                self.term_port,
+            '-e', 'connector Connect %s term' % self.args.renode_uart]
+
+    def wait(self, proc, expect):
+        deadline = time.monotonic() + (expect.remaining() or 60)
+        while True:
+            try:
+                uart = socket.create_connection(('localhost', self.term_port))
+                break
+            except ConnectionRefusedError:
+                if proc.poll() is not None or time.monotonic() > deadline:
+                    return expect.finish('eof')
+                time.sleep(0.05)
+        with uart:
+            monitor = RenodeMonitor(port=self.monitor_port)
+            try:
+                monitor.connect(max(deadline - time.monotonic(), 1.0))
+                monitor.start()
+            finally:
+                monitor.close()
+            return expect.wait_fd(uart)
+
+
+class VerilatorSimulator(Simulator):
+    """Runs a verilated model built with the OpenTitan chip_sim_tb
+    conventions. The model writes the UART to uart0.log in its working
+    directory, which is followed until the result shows up."""
+
+    name = 'verilator'
+    stdout = subprocess.DEVNULL
+
+    def command(self, boot_elf, vector_elf):
+        extra = self.args.verilator_args.format(boot_elf=boot_elf,
+                                                vector_elf=vector_elf)
+        return [self.path] + shlex.split(extra)
+
+    def fingerprint(self):
+        return '%s:%s' % (super().fingerprint(), self.args.verilator_args)
+
+    def run(self, boot_elf, vector_elf):
+        with tempfile.TemporaryDirectory() as work_dir:
+            self.cwd = work_dir
+            return super().run(boot_elf, vector_elf)
+
+    def wait(self, proc, expect):
+        log_path = os.path.join(self.cwd, 'uart0.log')
+        log_file = None
+
+        def read(timeout):
+            nonlocal log_file
+            if log_file is None and os.path.exists(log_path):
+                log_file = open(log_path, 'rb')
+            data = log_file.read(65536) if log_file else b''
+            if data:
+                return data
+            if proc.poll() is not None:
+                return b''
+            time.sleep(min(0.05, timeout if timeout is not None else 0.05))
+            return None
+
+        try:
+            return expect.wait(read)
+        finally:
+            if log_file:
+                log_file.close()
+
+
+SIMULATORS = {
+    simulator.name: simulator for simulator in
+    (QemuSimulator, RenodeSimulator, SpikeSimulator, VerilatorSimulator)
+}
+
+
+class RuntimeDatabase:
+    """Recorded runtime of each test on each simulator, keyed by the vector
+    ELF's file name, used by --simulator auto."""
+
+    def __init__(self, path):
+        self.path = path
+        self.runtimes = load_json(path, {})
+
+    def record(self, test, simulator, seconds, status):
+        entry = self.runtimes.setdefault(test, {}).setdefault(
+            simulator, {'runs': 0, 'seconds': seconds})
+        # Running mean that favors recent runs
+        entry['seconds'] = 0.5 * (entry['seconds'] + seconds)
+        entry['runs'] += 1
+        entry['status'] = status
+
+    def save(self):
+        save_json(self.path, self.runtimes)
+
+    def fastest(self, test, candidates):
+        """The candidate that passed this test fastest, or None if none of
+        them has passed it yet."""
+        passed = [(entry['seconds'], name)
+                  for name, entry in self.runtimes.get(test, {}).items()
+                  if name in candidates and entry.get('status') == 'pass']
+        return min(passed)[1] if passed else None
+
+    def untried(self, test, candidates):
+        """The candidates with no recorded run of this test, in order."""
+        runs = self.runtimes.get(test, {})
+        return [name for name in candidates if name not in runs]
+
+
+class ResultCache:
+    """Final results keyed by the simulator, boot ELF and vector ELF
+    contents, so a batch rerun skips tests none of them changed for."""
+
+    # Timeouts and crashes say more about the host than the test.
+    cached_statuses = ('pass', 'fail')
+
+    def __init__(self, path):
+        self.path = path
+        self.results = load_json(path, {})
+
+    @staticmethod
+    def key(fingerprint, boot_digest, vector_digest):
+        return '%s:%s:%s' % (fingerprint, boot_digest, vector_digest)
+
+    def get(self, key):
+        return self.results.get(key)
+
+    def put(self, key, result):
+        if result['status'] in self.cached_statuses:
+            self.results[key] = result
+
+    def save(self):
+        save_json(self.path, self.results)
+
+
 def get_parser():
     parser = argparse.ArgumentParser()
-    # TODO(julianmb): support multiple simulators(qemu, renode, spike, verilator)
     parser.add_argument(
         '--simulator',
         required=True,
-        choices=['qemu', 'renode', 'spike', 'verilator'])
+        choices=['auto'] + sorted(SIMULATORS),
+        help='auto runs each test once on every available simulator, then '
+        'on the fastest one that passed it, per --runtime-db')
     parser.add_argument('--boot-elf-path', required=True)
-    parser.add_argument('--vector-elf-path', required=True)
+    vector = parser.add_mutually_exclusive_group(required=True)
+    vector.add_argument('--vector-elf-path')
+    vector.add_argument('--vector-elf-dir',
+                        help='run every *.elf below this directory')
+    vector.add_argument('--manifest',
+                        help='run the ELFs listed in this file, one per line')
     parser.add_argument('--simulator-path')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='tests run at once in batch mode')
+    parser.add_argument('--junit', help='batch mode JUnit report path')
+    parser.add_argument('--result-cache',
+                        default=os.path.join(OUT, 'vector-simulation',
+                                             'results.json'))
+    parser.add_argument('--no-cache', action='store_true',
+                        help='rerun tests with a cached result')
+    for name in sorted(SIMULATORS):
+        parser.add_argument('--%s-path' % name,
+                            help='%s binary used by --simulator auto' % name)
+    parser.add_argument('--renode-script',
+                        help='renode script that creates the machine')
+    parser.add_argument('--renode-uart', default='sysbus.uart')
+    parser.add_argument('--verilator-args',
+                        default='--meminit=rom,{boot_elf} '
+                        '--meminit=flash,{vector_elf}',
+                        help='model arguments, {boot_elf} and {vector_elf} '
+                        'are replaced by the ELF paths')
+    parser.add_argument('--runtime-db',
+                        default=os.path.join(OUT, 'vector-simulation',
+                                             'runtimes.json'))
+    parser.add_argument('--persistent-qemu', action='store_true',
+                        help='keep QEMU running between tests and only load '
+                        'each vector ELF into it')
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='seconds to wait for the test result')
+    parser.add_argument('--inactivity-timeout', type=float, default=120,
+                        help='seconds without output before giving up')
     return parser
 
 
+def make_simulator(name, args):
+    path = getattr(args, '%s_path' % name)
+    if args.simulator == name and args.simulator_path:
+        path = args.simulator_path
+    return SIMULATORS[name](args, path)
+
+
+# Order in which --simulator auto tries the simulators a test has not run on.
+AUTO_ORDER = ['spike', 'qemu', 'renode', 'verilator']
+
+
+def choose_simulator(args, database, vector_elf):
+    test = os.path.basename(vector_elf)
+    candidates = {}
+    for name in AUTO_ORDER:
+        simulator = make_simulator(name, args)
+        if simulator.available() and simulator.supports(vector_elf):
+            candidates[name] = simulator
+    if not candidates:
+        raise SimulationFailedError('No simulator available for %s' % test)
+    # Measure every simulator before settling on the fastest
+    untried = database.untried(test, candidates)
+    if untried:
+        return candidates[untried[0]]
+    name = database.fastest(test, candidates) or next(iter(candidates))
+    return candidates[name]
+
+
+def error_result(name, vector_elf, simulator_name, detail=''):
+    return {'name': name, 'elf': vector_elf, 'simulator': simulator_name,
+            'status': 'error', 'detail': detail, 'cached': False,
+            'seconds': 0.0, 'startup_seconds': None}
+
+
+def run_test(args, simulator_name, name, vector_elf):
+    """Runs one test of a batch in a worker process."""
+    result = error_result(name, vector_elf, simulator_name)
+    start = time.monotonic()
+    simulator = make_simulator(simulator_name, args)
+    try:
+        outcome = simulator.run(args.boot_elf_path, vector_elf)
+        result['status'] = outcome.status
+        result['detail'] = outcome.detail
+    except (OSError, ValueError, SimulationFailedError) as e:
+        result['detail'] = str(e)
+    result['seconds'] = time.monotonic() - start
+    result['startup_seconds'] = simulator.startup_seconds
+    return result
+
+
+def find_vector_elfs(args):
+    """Returns (test name, path) for each ELF of the batch."""
+    if args.vector_elf_dir:
+        elfs = []
+        for root, _, files in os.walk(args.vector_elf_dir):
+            elfs += [os.path.join(root, f) for f in files
+                     if f.endswith('.elf')]
+        return [(os.path.relpath(elf, args.vector_elf_dir), elf)
+                for elf in sorted(elfs)]
+    base = os.path.dirname(os.path.abspath(args.manifest))
+    with open(args.manifest, 'r', encoding='utf-8') as f:
+        lines = [line.strip() for line in f]
+    return [(line, os.path.join(base, line)) for line in lines
+            if line and not line.startswith('#')]
+
+
+def run_batch(args, database):
+    """Runs every ELF of the batch in a process pool and returns whether all
+    of them passed. Simulators are chosen, and the runtime database and
+    result cache are updated, in this process only."""
+    cache = ResultCache(args.result_cache)
+    boot_digest = file_digest(args.boot_elf_path)
+    fingerprints = {}
+    results = []
+    pending = {}
+    # A test that can't be set up or whose worker dies is reported as an
+    # error, the rest of the batch still runs and is reported and cached.
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max(args.jobs, 1)) as pool:
+            for name, vector_elf in find_vector_elfs(args):
+                simulator_name = args.simulator
+                try:
+                    if args.simulator == 'auto':
+                        simulator = choose_simulator(args, database,
+                                                     vector_elf)
+                    else:
+                        simulator = make_simulator(args.simulator, args)
+                    simulator_name = simulator.name
+                    if simulator.name not in fingerprints:
+                        fingerprints[simulator.name] = simulator.fingerprint()
+                    key = cache.key(fingerprints[simulator.name], boot_digest,
+                                    file_digest(vector_elf))
+                except (OSError, ValueError, SimulationFailedError) as e:
+                    logger.info('%s: %s', name, e)
+                    results.append(error_result(name, vector_elf,
+                                                simulator_name, str(e)))
+                    continue
+                cached = None if args.no_cache else cache.get(key)
+                if cached is not None:
+                    results.append(dict(cached, name=name, cached=True,
+                                        seconds=0.0))
+                    continue
+                future = pool.submit(run_test, args, simulator.name, name,
+                                     vector_elf)
+                pending[future] = (key, name, vector_elf, simulator.name)
+
+            for future in concurrent.futures.as_completed(pending):
+                key, name, vector_elf, simulator_name = pending[future]
+                try:
+                    result = future.result()
+                except Exception as e:  # pylint: disable=broad-except
+                    logger.info('%s on %s: worker failed: %r', name,
+                                simulator_name, e)
+                    results.append(error_result(name, vector_elf,
+                                                simulator_name, repr(e)))
+                    continue
+                logger.info('%s on %s: %s (%.1fs%s)', result['name'],
+                            result['simulator'], result['status'],
+                            result['seconds'],
+                            '' if result['startup_seconds'] is None else
+                            ', %.1fs startup' % result['startup_seconds'])
+                database.record(os.path.basename(result['elf']),
+                                result['simulator'], result['seconds'],
+                                result['status'])
+                cache.put(key, result)
+                results.append(result)
+    finally:
+        database.save()
+        cache.save()
+        results.sort(key=lambda result: result['name'])
+        if args.junit:
+            write_junit(results, args.junit, 'vector-simulation',
+                        lambda result: result['simulator'],
+                        lambda result: 'cached result' if result['cached']
+                        else None)
+    passed = sum(result['status'] == 'pass' for result in results)
+    cached = sum(result['cached'] for result in results)
+    logger.info('%d/%d passed, %d from cache', passed, len(results), cached)
+    return passed == len(results)
+
+
 def main():
     args = get_parser().parse_args()
-    if args.simulator == 'qemu':
-        run_qemu_simulation(args)
-    elif args.simulator == 'renode':
-        raise NotImplementedError
-    elif args.simulator == 'spike':
-        raise NotImplementedError
-    elif args.simulator == 'verilator':
-        raise NotImplementedError
-    logger.info('test passed')
+    database = RuntimeDatabase(args.runtime_db)
+    if not args.vector_elf_path:
+        if not run_batch(args, database):
+            raise SimulationFailedError('some tests failed')
+        return
+    if args.simulator == 'auto':
+        simulator = choose_simulator(args, database, args.vector_elf_path)
+    else:
+        simulator = make_simulator(args.simulator, args)
+    logger.info('running on %s', simulator.name)
 
-def run_qemu_simulation(args):
-    cmd = [args.simulator_path,
-        '-display', 'none',
-        '-cpu', 'rv32,x-v=true,vlen=512,vext_spec=v1.0',
-        '-M', 'opentitan',
-        '-kernel', args.vector_elf_path,
-        '-bios', args.boot_elf_path,
-        '--chardev', 'file,id=s1,path=/dev/stdout',
-        '-serial', 'chardev:s1']
-    proc = subprocess.Popen(
-        cmd, bufsize=0,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE)
-    stdout = proc.stdout
-    test_finished_pattern = r'test_status\.c.*(PASS|FAIL)'
-    while line:= stdout.readline():
-        line = str(line, encoding='utf8').strip()
-        logger.debug('line = %s', line)
-        if(re.search(test_finished_pattern, line)):
-            logger.debug('test finished')
-            break
-    if 'PASS' not in line:
-        raise SimulationFailedError
+    start = time.monotonic()
+    result = simulator.run(args.boot_elf_path, args.vector_elf_path)
+    seconds = time.monotonic() - start
+    logger.info('finished in %.1fs', seconds)
+    logger.debug('test finished: %s', result.as_dict())
+    database.record(os.path.basename(args.vector_elf_path), simulator.name,
+                    seconds, result.status)
+    database.save()
+    if not result.ok:
+        raise SimulationFailedError(result.detail)
+    logger.info('test passed')
 
 
 if __name__ == '__main__':
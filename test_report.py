@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+#
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Result files shared by the simulation runners.
+
+load_json() and save_json() keep state such as a runtime database or result
+cache between runs; save_json() replaces the file in one step, so a run that
+is interrupted or races another never leaves a partial file behind.
+write_junit() writes a batch of test results as a JUnit XML report for CI.
+"""
+
+import json
+import os
+import xml.etree.ElementTree as ET
+
+
+def load_json(path, default):
+    """The value stored in {path}, or {default} if it is missing or
+    unreadable."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def save_json(path, value):
+    """Writes {value} to a temporary file renamed over {path}."""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = "%s.%d" % (path, os.getpid())
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(value, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def write_junit(results, path, suite_name, classname, system_out=None):
+    """Writes {results}, dicts with a name, status, detail and seconds, as
+    the JUnit test suite {suite_name}. {classname}(result) names the class
+    of each test case and {system_out}(result) its output, if any."""
+    suite = ET.Element("testsuite", {
+        "name": suite_name,
+        "tests": str(len(results)),
+        "failures": str(sum(r["status"] == "fail" for r in results)),
+        "errors": str(sum(r["status"] not in ("pass", "fail")
+                          for r in results)),
+        "skipped": "0",
+        "time": "%.3f" % sum(r["seconds"] for r in results),
+    })
+    for result in results:
+        case = ET.SubElement(suite, "testcase", {
+            "name": result["name"],
+            "classname": classname(result),
+            "time": "%.3f" % result["seconds"],
+        })
+        if result["status"] == "fail":
+            ET.SubElement(case, "failure", {"message": result["detail"]})
+        elif result["status"] != "pass":
+            message = result["status"]
+            if result["detail"]:
+                message += ": " + result["detail"]
+            ET.SubElement(case, "error", {"message": message})
+        output = system_out(result) if system_out else None
+        if output:
+            ET.SubElement(case, "system-out").text = output
+    ET.ElementTree(suite).write(path, encoding="utf-8", xml_declaration=True)
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+#
+# Copyright 2023 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Waits for patterns in simulator UART output.
+
+An UartExpect is fed raw bytes from wherever the UART ends up (a QEMU pipe,
+a Renode socket terminal, a bootshell link) and matches a set of compiled
+byte patterns against them without decoding or splitting lines. Patterns with
+an outcome ("pass", "fail", "panic", ...) end the wait, patterns without one
+are only recorded. The wait also ends on a global timeout, after too long
+without output, or at EOF.
+"""
+
+import asyncio
+import os
+import re
+import select
+import socket
+import time
+
+
+class Expect:
+    """A named byte pattern. {outcome} is the status to finish with when it
+    matches, or None to record matches and keep waiting."""
+
+    def __init__(self, name, pattern, outcome=None):
+        if isinstance(pattern, str):
+            pattern = pattern.encode()
+        if isinstance(pattern, bytes):
+            pattern = re.compile(pattern)
+        self.name = name
+        self.pattern = pattern
+        self.outcome = outcome
+
+
+class Match:
+    def __init__(self, name, text, offset, seconds):
+        self.name = name
+        self.text = text
+        self.offset = offset
+        self.seconds = seconds
+
+    def as_dict(self):
+        return {"name": self.name, "text": self.text, "offset": self.offset,
+                "seconds": self.seconds}
+
+
+class ExpectResult:
+    """How a wait ended. {status} is the outcome of the pattern that matched,
+    or "timeout", "inactive" or "eof"."""
+
+    def __init__(self, status, match, matches, seconds, received):
+        self.status = status
+        self.match = match
+        self.matches = matches
+        self.seconds = seconds
+        self.received = received
+
+    @property
+    def ok(self):
+        return self.status == "pass"
+
+    @property
+    def detail(self):
+        if self.match is not None:
+            return self.match.text
+        return "%s after %.1fs, %d bytes received" % (
+            self.status, self.seconds, self.received)
+
+    def as_dict(self):
+        return {
+            "status": self.status,
+            "match": self.match.as_dict() if self.match else None,
+            "matches": [match.as_dict() for match in self.matches],
+            "seconds": self.seconds,
+            "received": self.received,
+        }
+
+
+def test_status_expects():
+    """The pass/fail lines printed by the vector tests' test_status.c."""
+    return [Expect("pass", rb"test_status\.c.*PASS", "pass"),
+            Expect("fail", rb"test_status\.c.*FAIL", "fail")]
+
+
+class UartExpect:
+    """Matches {expects} incrementally over a byte stream. A match may span
+    any number of reads but has to fit in the last {window} bytes.
+
+    {timeout} bounds the whole wait and {inactivity_timeout} the time between
+    two reads that return data; either may be None. With {transcript} every
+    byte fed is also written there."""
+
+    def __init__(self, expects, timeout=None, inactivity_timeout=None,
+                 window=4096, transcript=None):
+        self.expects = list(expects)
+        self.timeout = timeout
+        self.inactivity_timeout = inactivity_timeout
+        self.window = window
+        self.transcript = transcript
+        self.buffer = bytearray()
+        # Stream offset of buffer[0]
+        self.base = 0
+        self.received = 0
+        self.matches = []
+        # Stream offset where each pattern's last recorded match ended, so a
+        # match that grows over several reads is only recorded once.
+        self.recorded_end = {}
+        self.result = None
+        self.start = time.monotonic()
+        self.last_data = self.start
+
+    def finish(self, status, match=None):
+        self.result = ExpectResult(status, match, self.matches,
+                                   time.monotonic() - self.start,
+                                   self.received)
+        return self.result
+
+    def feed(self, data):
+        """Adds received bytes. Returns the result once the wait is over."""
+        if self.result is not None:
+            return self.result
+        now = time.monotonic()
+        self.last_data = now
+        if self.transcript is not None:
+            self.transcript.write(data)
+        # Matches are only new if they end in the bytes just added
+        new_from = len(self.buffer)
+        self.buffer += data
+        self.received += len(data)
+
+        # The earliest match of a pattern that ends the wait, and its outcome
+        outcome = None
+        finished = None
+        for expect in self.expects:
+            for found in expect.pattern.finditer(self.buffer):
+                if (found.end() <= new_from or self.base + found.start() <
+                        self.recorded_end.get(expect.name, 0)):
+                    continue
+                match = Match(expect.name,
+                              found.group(0).decode(errors="replace"),
+                              self.base + found.start(), now - self.start)
+                if expect.outcome is None:
+                    self.matches.append(match)
+                    self.recorded_end[expect.name] = self.base + found.end()
+                    continue
+                if finished is None or match.offset < finished.offset:
+                    outcome = expect.outcome
+                    finished = match
+                break
+
+        if len(self.buffer) > self.window:
+            trim = len(self.buffer) - self.window
+            del self.buffer[:trim]
+            self.base += trim
+        if finished is not None:
+            self.matches.append(finished)
+            self.matches.sort(key=lambda match: match.offset)
+            return self.finish(outcome, finished)
+        return None
+
+    def remaining(self):
+        """Seconds until the nearer of the two timeouts, or None."""
+        now = time.monotonic()
+        deadlines = []
+        if self.timeout is not None:
+            deadlines.append(self.start + self.timeout)
+        if self.inactivity_timeout is not None:
+            deadlines.append(self.last_data + self.inactivity_timeout)
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - now)
+
+    def check(self):
+        """Returns the result if a timeout has passed."""
+        if self.result is not None:
+            return self.result
+        now = time.monotonic()
+        if self.timeout is not None and now - self.start >= self.timeout:
+            return self.finish("timeout")
+        if (self.inactivity_timeout is not None and
+                now - self.last_data >= self.inactivity_timeout):
+            return self.finish("inactive")
+        return None
+
+    def wait(self, read):
+        """Feeds the output of {read}(timeout) until the wait is over. {read}
+        returns None if nothing arrived in time and b"" at EOF."""
+        while True:
+            result = self.check()
+            if result is not None:
+                return result
+            data = read(self.remaining())
+            if data == b"":
+                return self.finish("eof")
+            if data:
+                result = self.feed(data)
+                if result is not None:
+                    return result
+
+    def wait_fd(self, source):
+        """Waits on a socket, a file object or a raw file descriptor such as
+        a subprocess pipe."""
+        if isinstance(source, socket.socket):
+            def recv_socket(timeout):
+                source.settimeout(timeout)
+                try:
+                    return source.recv(65536)
+                except socket.timeout:
+                    return None
+            return self.wait(recv_socket)
+
+        fd = source if isinstance(source, int) else source.fileno()
+
+        def read_fd(timeout):
+            ready, _, _ = select.select([fd], [], [], timeout)
+            if not ready:
+                return None
+            return os.read(fd, 65536)
+        return self.wait(read_fd)
+
+    async def wait_async(self, reader):
+        """Waits on an asyncio StreamReader or anything with an async
+        read(size) such as launch_renode.AsyncUart."""
+        while True:
+            result = self.check()
+            if result is not None:
+                return result
+            try:
+                data = await asyncio.wait_for(reader.read(65536),
+                                              self.remaining())
+            except asyncio.TimeoutError:
+                continue
+            if not data:
+                return self.finish("eof")
+            result = self.feed(data)
+            if result is not None:
+                return result